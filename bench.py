@@ -0,0 +1,405 @@
+#!/usr/bin/python3
+# vim: set noet ts=4 sw=4 fileencoding=utf-8:
+
+'''
+性能测试脚本。用法：python3 bench.py [name [args...]]
+'''
+
+import sys
+import re
+import time
+import timeit
+import os
+import random
+import shutil
+import sqlite3
+import datetime
+import tempfile
+import itertools
+import collections
+import subprocess
+import multiprocessing
+
+import patterns
+import wxxml
+from processor import ExtPattern
+from utils import frozenClock
+
+#语料中的相对日期都以此为“现在”解析
+frozenNow = datetime.datetime(2017, 5, 24, 10, 0) #周三
+goldenPath = 'patterns.golden'
+
+
+def report(name, number, seconds):
+	print('{:<32} {:>8} 次  {:>8.2f} us/次'.format(name, number, seconds/number*1e6))
+
+
+def percentile(sortedList, p):
+	return sortedList[min(len(sortedList)-1, int(len(sortedList)*p))]
+
+
+def benchPattern(number='2000'):
+	'对比每次重新拼接正则（旧）与使用预编译正则（新）的开销'
+	number = int(number)
+	reservation = ExtPattern.collection['reservation']
+	reservation.compile()
+	inputStr = '明天七点半到九点三刻 B252'
+
+	report('calcPattern + re.match', number, timeit.timeit(
+		lambda: re.match(reservation.calcPattern(), inputStr), number=number))
+	report('compiled regex.match', number, timeit.timeit(
+		lambda: reservation.regex.match(inputStr), number=number))
+	def parse():
+		patterns.reservation.cacheClear()
+		return patterns.reservation('预约'+inputStr)
+	report('patterns.reservation (uncached)', number, timeit.timeit(parse, number=number))
+
+
+def benchStartup(number='10'):
+	"""
+	在新进程中测量导入patterns并完成各入口首次解析的耗时。
+	all为导入时编译所有模式，commands为现在的做法：导入时只编译命令的模式，其余的在首次匹配时编译。
+	uwsgi中导入只在master中进行一次，首次解析的耗时则每个worker都有。
+	"""
+	firstParse = ('patterns.reservation("预约明天七点到九点"); patterns.cancellation("取消明天七点"); '
+			'patterns.query("查询明天"); patterns.queryMyself("查询我的预约"); patterns.iAm("我是张三")')
+	eager = 'from processor import ExtPattern; [x.compile() for x in ExtPattern.collection.values()]; '
+	for label, code in [('all', eager+firstParse), ('commands', firstParse)]:
+		code = ('import time; t = time.perf_counter(); import patterns; {}; '
+				'print(time.perf_counter()-t)'.format(code))
+		seconds = sorted(float(subprocess.check_output([sys.executable, '-c', code]))
+				for i in range(int(number)))
+		print('{:<8} p50 {:>7.2f} ms  min {:>7.2f} ms'.format(
+			label, percentile(seconds, 0.5)*1e3, seconds[0]*1e3))
+
+
+def benchParseCache(number='2000'):
+	'重复的常用查询在有缓存与每次清空缓存时的开销'
+	number = int(number)
+	inputs = ['查询今天', '查询明天', '查询这周', '查询下周', '查询我的预约']
+	def parse():
+		for inputStr in inputs:
+			(patterns.queryMyself if '我的' in inputStr else patterns.query)(inputStr)
+	def parseUncached():
+		patterns.query.cacheClear()
+		patterns.queryMyself.cacheClear()
+		parse()
+
+	report('uncached', number*len(inputs), timeit.timeit(parseUncached, number=number))
+	report('cached', number*len(inputs), timeit.timeit(parse, number=number))
+	print('query', patterns.query.cacheInfo())
+
+
+def grammarCorpus():
+	'返回{模式名: 输入列表}'
+	dates = ['', '今天', '今', '明天', '明', '后天', '大后天', '大大后天',
+			'十五号', '3号', '三月一号', '六月三十号', '2017年6月1号', '十二月三十一日',
+			'周三', '周日', '下周三', '下下周三', '这周五', '本礼拜六', '下星期天', '下下下周二',
+			'今天的', '十三月一号', '三十二号', '周八']
+	times = [('七点', '九点'), ('7:00', '9:00'), ('19：00', '21：00'), ('７点', '９点'),
+			('下午三点', '五点'), ('七点半', '九点三刻'), ('上午十点', '十二点'),
+			('晚上七点', '九点半'), ('早上8点15', '9点15分'), ('两点', '四点'),
+			('下午十三点', '十五点'), ('二十五点', '二十六点'), ('九点', '七点'), ('十点四刻', '十一点')]
+	tos = ['到', '-', '～']
+	rooms = ['', '的B253']
+
+	return dict(
+		reservation = ['预约{}{}{}{}{}'.format(d, t1, to, t2, r)
+			for d, (t1, t2), to, r in itertools.product(dates, times, tos, rooms)],
+		cancellation = ['{}{}{}{}'.format(c, d, t, r)
+			for c, d, t, r in itertools.product(['取消', '取消预约'], dates,
+				[x[0] for x in times[:7]] + ['{}至{}'.format(*x) for x in times[:7]],
+				[' B252', ' b250'])],
+		query = ['{}{}{}'.format(q, d, s)
+			for q, d, s in itertools.product(['查询', '查询预约'],
+				dates + ['这周', '本周', '下周', '下下周', '这星期', '下礼拜', '周', '下下下周'],
+				['', '下午', '的预约'])],
+		queryMyself = ['查询我的预约', '查询我的预约 ', '查询我的预约吧', '查询我的', '查询'],
+		iAm = ['我是张三', '我是 李四', '我是', '我是 王 五', '我是　赵六', '我是欧阳娜娜\n'],
+		freeSlots = ['空闲{}{}{}'.format(d, s, l)
+			for d, s, l in itertools.product(dates[:12] + ['这周', '下周', '下下周'], ['', '下午', '上午', '晚上', '早上', '傍晚'],
+				['', ' 1小时', '两个小时', '一个半小时', ' 半小时', '90分钟', '0分钟', '二十五小时'])],
+		recurringReservation = ['每{}{}到{}{} 预约{}'.format(w, t1, t2, r, n)
+			for w, (t1, t2), r, n in itertools.product(['周三', '周日', '星期一', '礼拜六', '下周二', '周八'],
+				times, ['', ' B252', '的B253'], ['四周', '两次', '2个星期', '零周', '五十三周', ''])],
+	)
+
+
+def parseAll(name, inputs):
+	'逐个解析，返回[(输入, 输出)]和每次解析的耗时。每次先清空解析缓存，测量的是语法本身'
+	entry = getattr(patterns, name)
+	results, latencies = [], []
+	with frozenClock(frozenNow):
+		for inputStr in inputs:
+			entry.cacheClear()
+			t = time.perf_counter()
+			try: result = repr(entry(inputStr))
+			except ValueError as e: result = '{}: {}'.format(e.__class__.__name__, e)
+			latencies.append(time.perf_counter() - t)
+			results.append((inputStr, result))
+	return results, latencies
+
+
+def benchGrammar(rounds='3'):
+	'各模式的吞吐量与p50/p99延迟'
+	for name, inputs in sorted(grammarCorpus().items()):
+		latencies = []
+		for i in range(int(rounds)):
+			latencies += parseAll(name, inputs)[1]
+		latencies.sort()
+		print('{:<20} {:>6} 条  {:>8.0f} 条/秒  p50 {:>7.2f} us  p99 {:>7.2f} us'.format(
+			name, len(inputs), len(latencies)/sum(latencies),
+			percentile(latencies, 0.5)*1e6, percentile(latencies, 0.99)*1e6))
+
+
+def formatGolden():
+	lines = []
+	for name, inputs in sorted(grammarCorpus().items()):
+		for inputStr, result in parseAll(name, inputs)[0]:
+			lines.append('{}\t{!r}\t{}\n'.format(name, inputStr, result))
+	return lines
+
+
+def checkGolden(update=None):
+	'与patterns.golden对比解析结果，有差异时退出码非0。参数为update时重新生成'
+	lines = formatGolden()
+	if update == 'update':
+		with open(goldenPath, 'w') as f:
+			f.writelines(lines)
+		print('{} lines written to {}'.format(len(lines), goldenPath))
+		return
+
+	with open(goldenPath) as f:
+		golden = f.readlines()
+	diff = [(x, y) for x, y in itertools.zip_longest(golden, lines) if x != y]
+	for x, y in diff[:20]:
+		print('- {}+ {}'.format(x, y))
+	print('{} lines, {} differ'.format(len(lines), len(diff)))
+	if diff:
+		sys.exit(1)
+
+
+def writerWorker(args):
+	'一个模拟uwsgi worker的进程：每个事务先读后写，与处理消息时相同'
+	path, profile, number = args
+	import sqlalchemy
+	from sqlalchemy.exc import OperationalError
+	from config import sqliteProfiles, setPragmas
+	engine = sqlalchemy.create_engine('sqlite:///'+path, poolclass=sqlalchemy.pool.QueuePool)
+	sqlalchemy.event.listen(engine, 'connect', setPragmas(sqliteProfiles[profile]))
+
+	latencies, errors = [], 0
+	for i in range(number):
+		t = time.perf_counter()
+		try:
+			with engine.begin() as conn:
+				conn.execute('select count(*) from message').scalar()
+				conn.execute('insert into message (content) values (?)', 'x'*64)
+		except OperationalError:
+			errors += 1
+		latencies.append(time.perf_counter() - t)
+	return latencies, errors
+
+
+def benchWriters(workers='4', number='300'):
+	'多个进程同时读写同一个数据库文件，对比各个sqliteProfiles的吞吐量、延迟和锁错误数'
+	from config import sqliteProfiles
+	for profile in sorted(sqliteProfiles):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			path = tmpdir + '/db'
+			with sqlite3.connect(path) as conn:
+				conn.execute('create table message (id integer primary key, content text)')
+
+			t = time.perf_counter()
+			with multiprocessing.Pool(int(workers)) as pool:
+				results = pool.map(writerWorker, [(path, profile, int(number))]*int(workers))
+			seconds = time.perf_counter() - t
+
+		latencies = sorted(x for result in results for x in result[0])
+		print('{:<8} {:>8.0f} 事务/秒  p50 {:>7.2f} ms  p99 {:>7.2f} ms  锁错误 {}'.format(
+			profile, len(latencies)/seconds, percentile(latencies, 0.5)*1e3,
+			percentile(latencies, 0.99)*1e3, sum(result[1] for result in results)))
+
+
+def bookingInit(path):
+	"""
+	从副本所在目录导入main（flask-sqlalchemy按main.py所在目录解析数据库路径），
+	使每个进程像uwsgi worker一样有自己的连接和占用索引
+	"""
+	os.chdir(path)
+	sys.path.insert(0, path)
+	global main
+	import main
+
+
+def bookingWorker(args):
+	openId, inputStr = args
+	from flask import g
+	from sqlalchemy.exc import OperationalError
+	t = time.perf_counter()
+	with main.app.test_request_context():
+		g.openId = openId
+		try:
+			reply = main.processReservation(inputStr)['Content']
+		except OperationalError as e:
+			reply = 'error: {}'.format(e)
+	return reply, time.perf_counter() - t
+
+
+def benchBooking(workers='4', users='200', attempts='3'):
+	"""
+	很多用户同时预约明天的少数几个时段。
+	结束后检查数据库：同一房间的预约不能重叠，每人的活跃预约不能超过限额，否则退出码非0
+	"""
+	tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+	random.seed(1)
+	tasks = []
+	for i in range(int(users)):
+		for j in range(int(attempts)):
+			hour = random.randrange(8, 22)
+			tasks.append(('bench{}'.format(i), '预约{}年{}月{}号{}点到{}点'.format(
+				tomorrow.year, tomorrow.month, tomorrow.day, hour, hour+1)))
+	random.shuffle(tasks)
+
+	with tempfile.TemporaryDirectory() as tmpdir:
+		for name in ['db', 'default.ini'] + [x for x in os.listdir('.') if x.endswith('.py')]:
+			shutil.copy(name, tmpdir)
+		shutil.copytree('migrations', tmpdir+'/migrations')
+		subprocess.check_call([sys.executable, 'main.py', 'db', 'upgrade'], cwd=tmpdir,
+				stderr=subprocess.DEVNULL)
+		with sqlite3.connect(tmpdir+'/db') as conn:
+			conn.execute('delete from reservation where start>=?', (str(tomorrow),))
+			conn.executemany('insert into user (openId, name) values (?, ?)',
+				[('bench{}'.format(i), 'bench{}'.format(i)) for i in range(int(users))])
+
+		with multiprocessing.get_context('spawn').Pool(int(workers), bookingInit, (tmpdir,)) as pool:
+			pool.map(time.sleep, [0.1]*int(workers)) #等所有进程导入完毕
+			t = time.perf_counter()
+			results = pool.map(bookingWorker, tasks, chunksize=1)
+			seconds = time.perf_counter() - t
+
+		with sqlite3.connect(tmpdir+'/db') as conn:
+			rows = conn.execute('select roomId, start, end, userId from reservation '
+					'where start>=? order by roomId, start', (str(tomorrow),)).fetchall()
+	latencies = sorted(x[1] for x in results)
+	outcomes = collections.Counter(x[0].split()[0] for x in results)
+	print('{} 次预约  {:>6.0f} 次/秒  p50 {:>7.2f} ms  p99 {:>7.2f} ms'.format(
+		len(tasks), len(tasks)/seconds, percentile(latencies, 0.5)*1e3, percentile(latencies, 0.99)*1e3))
+	for reply, count in outcomes.most_common():
+		print('{:>6}  {}'.format(count, reply))
+
+	doubleBooked = [(x, y) for x, y in zip(rows, rows[1:]) if x[0]==y[0] and y[1]<x[2]]
+	overQuota = [(userId, count) for userId, count
+			in collections.Counter(x[3] for x in rows).items() if count > 2]
+	print('{} 个预约，{} 处重叠，{} 人超出限额'.format(len(rows), len(doubleBooked), len(overQuota)))
+	if doubleBooked or overQuota:
+		sys.exit(1)
+
+
+def toEtree(d, name='xml'):
+	'原来的回复序列化方法，作为对比'
+	from lxml import etree
+	e = etree.Element(name)
+	if isinstance(d, dict):
+		for k,v in d.items():
+			e.append(toEtree(v, name=k))
+	elif isinstance(d, tuple) or isinstance(d, list):
+		for k,v in d:
+			e.append(toEtree(v, name=k))
+	else:
+		e.text = str(d)
+	return e
+
+
+def benchReply(number='5000'):
+	'每条回复的序列化开销，以及收到的消息的解析开销'
+	number = int(number)
+	from lxml import etree
+	replies = dict(
+		text = dict(MsgType='text', Content='2017年5月25日：\n[B252]\n07:00~09:00 张三\n\n[B253]\n10:00~11:00 李四*'),
+		news = dict(MsgType='news', ArticleCount=3, Articles=[('item', dict(Title='歌曲{}'.format(i),
+			Url='http://www.xiami.com/song/{}'.format(i), PicUrl='http://img.xiami.net/{}.jpg'.format(i)))
+			for i in range(3)]),
+	)
+	for msgType, replyDict in sorted(replies.items()):
+		def legacy():
+			reply = toEtree(dict(FromUserName='gh', ToUserName='o_test', CreateTime='1'))
+			for k,v in replyDict.items():
+				reply.append(toEtree(v, name=k))
+			return etree.tostring(reply, encoding='utf8')
+		report('{} toEtree + tostring'.format(msgType), number, timeit.timeit(legacy, number=number))
+		report('{} template'.format(msgType), number, timeit.timeit(
+			lambda: wxxml.formatReply('o_test', 'gh', '1', replyDict), number=number))
+
+	data = ('<xml><ToUserName><![CDATA[gh]]></ToUserName><FromUserName><![CDATA[o_test]]></FromUserName>'
+		'<CreateTime>1495591200</CreateTime><MsgType><![CDATA[text]]></MsgType>'
+		'<Content><![CDATA[查询明天]]></Content><MsgId>6425398428532391938</MsgId></xml>').encode('utf8')
+	def legacyParse():
+		e = etree.fromstring(data)
+		return [e.findtext(x) for x in 'MsgType MsgId ToUserName FromUserName CreateTime Content'.split()]
+	report('fromstring + findtext', number, timeit.timeit(legacyParse, number=number))
+	report('parseMessage', number, timeit.timeit(lambda: wxxml.parseMessage(data), number=number))
+
+
+def benchQuery(number='2000'):
+	"""
+	查询一天和一周的耗时：每次都重新生成（清空按日期缓存的文字）与使用缓存对比，
+	并检查两者的回复相同。在副本中运行，不修改仓库中的db
+	"""
+	number = int(number)
+	cwd = os.getcwd()
+	tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+	random.seed(1)
+	with tempfile.TemporaryDirectory() as tmpdir:
+		for name in ['db', 'default.ini'] + [x for x in os.listdir('.') if x.endswith('.py')]:
+			shutil.copy(name, tmpdir)
+		shutil.copytree('migrations', tmpdir+'/migrations')
+		subprocess.check_call([sys.executable, 'main.py', 'db', 'upgrade'], cwd=tmpdir,
+				stderr=subprocess.DEVNULL)
+		with sqlite3.connect(tmpdir+'/db') as conn:
+			conn.execute('insert into user (openId, name) values (?, ?)', ('bench', 'bench'))
+			roomIds = [x[0] for x in conn.execute('select id from room')]
+			conn.executemany('insert into reservation (userId, roomId, start, end) values (1, ?, ?, ?)',
+				[(roomId, str(start), str(start + datetime.timedelta(hours=1)))
+					for roomId in roomIds for day in range(8) for hour in random.sample(range(8, 22), 6)
+					for start in [datetime.datetime.combine(tomorrow, datetime.time(hour))
+						+ datetime.timedelta(days=day)]])
+		try:
+			bookingInit(tmpdir)
+			from flask import g
+			for inputStr in ['查询明天', '查询下周']:
+				with main.app.test_request_context():
+					g.openId = 'bench'
+					query = lambda: main.processQuery(inputStr)['Content']
+					def cold():
+						main.getOccupancy().renderCache.clear()
+						return query()
+					if cold() != query():
+						sys.exit('{} 使用缓存的回复不同'.format(inputStr))
+					report('{} 不使用缓存'.format(inputStr), number, timeit.timeit(cold, number=number))
+					report('{} 使用缓存'.format(inputStr), number, timeit.timeit(query, number=number))
+		finally:
+			os.chdir(cwd)
+			sys.path.remove(tmpdir)
+
+
+benches = dict(
+	pattern = benchPattern,
+	startup = benchStartup,
+	parsecache = benchParseCache,
+	grammar = benchGrammar,
+	golden = checkGolden,
+	writers = benchWriters,
+	booking = benchBooking,
+	reply = benchReply,
+	query = benchQuery,
+)
+
+
+if __name__=='__main__':
+	if len(sys.argv) > 1:
+		benches[sys.argv[1]](*sys.argv[2:])
+	else:
+		for name in sorted(benches):
+			print('== {} =='.format(name))
+			benches[name]()
@@ -0,0 +1,116 @@
+# vim: set noet ts=4 sw=4 fileencoding=utf-8:
+
+'''
+运行配置。读取环境变量PAPUWX_CONF指定的ini文件（默认为default.ini），
+uwsgi只读取其中的[uwsgi]节，其余各节由这里读取。
+'''
+
+import os
+import datetime
+import configparser
+
+defaults = {
+	'rooms': {
+		'practice': 'B252 B250', #按顺序分配的琴房
+		'classroom': 'B253', #有课时不可预约，且远期只有老师可以预约
+		'teacherOnlyDays': '2', #超过这么多天之后的classroom只有老师可以预约
+		'open': '8:00',
+		'close': '22:30',
+	},
+	'dedup': {
+		'store': 'memory', #memory：进程内，db：Message表，多个进程时使用
+		'window': '15', #memory存储保留记录的秒数
+		'wait': '4.5', #重试在第一次处理完毕之前最多等待的秒数，应小于微信的5秒超时
+	},
+	'maintenance': {
+		'messageDays': '1', #Message保留的天数
+		'reservationDays': '30', #开始于这么多天之前的预约会被归档
+		'batchSize': '500', #每个事务处理的行数
+		'interval': '0', #在uwsgi中每隔这么多秒执行一次，0为不执行
+	},
+	'fastack': {
+		'enabled': '0', #处理超过预算时先回复success，处理完毕后用客服消息发送结果
+		'workers': '4', #每个进程中处理消息的线程数
+		'budget': '4', #秒，微信最多等待5秒。可以在此节中按处理函数名单独设置，如 processQuery = 2
+		'sender': 'stub', #stub：只保存在进程内，wechat：调用客服消息接口
+	},
+	'wechat': {
+		'appId': '',
+		'appSecret': '',
+	},
+	'log': {
+		'path': 'requests.log', #可以包含{worker}，每个uwsgi worker写自己的文件
+		'maxBytes': str(10<<20), #超过此大小时轮转
+		'backupCount': '5',
+		'sampleRate': '1', #成功的请求按此比例记录，出错的请求总是记录
+		'salt': '', #计算openId的散列时使用
+	},
+	'metrics': {
+		'token': '', #访问/metrics和/occupancy时需要?token=，为空时不提供
+	},
+	'database': {
+		'profile': 'default', #见sqliteProfiles，可以在此节中单独覆盖其中的pragma
+		'pool': 'null', #null：每次请求新建连接，queue：每个进程保留连接
+	},
+}
+
+#多个uwsgi进程同时写入时，wal使读写互不阻塞，并在锁冲突时等待而不是立即失败
+sqliteProfiles = {
+	'default': {},
+	'wal': {
+		'journal_mode': 'WAL',
+		'synchronous': 'NORMAL',
+		'busy_timeout': '5000',
+		'mmap_size': str(64<<20),
+		'cache_size': '-8000', #单位为KiB
+	},
+}
+
+config = configparser.ConfigParser(interpolation=None)
+config.optionxform = str
+config.read_dict(defaults)
+config.read(os.environ.get('PAPUWX_CONF', 'default.ini'), encoding='utf8')
+
+
+def getTime(section, option):
+	hour, minute = config.get(section, option).split(':')
+	return datetime.time(int(hour), int(minute))
+
+
+def sqlitePragmas():
+	pragmas = dict(sqliteProfiles[config.get('database', 'profile')])
+	for key in config.options('database'):
+		if key not in defaults['database']:
+			pragmas[key] = config.get('database', key)
+	return pragmas
+
+
+def commandBudgets():
+	'处理函数名 -> 单独设置的预算秒数'
+	return {key: config.getfloat('fastack', key) for key in config.options('fastack')
+			if key not in defaults['fastack']}
+
+
+def setPragmas(pragmas):
+	'返回在每个新连接上执行PRAGMA的connect事件处理函数'
+	def onConnect(dbapiConnection, connectionRecord):
+		cursor = dbapiConnection.cursor()
+		for key, value in pragmas.items():
+			cursor.execute('PRAGMA {}={}'.format(key, value))
+		cursor.close()
+	return onConnect
+
+
+class RoomPolicy:
+	def __init__(self):
+		self.practiceRooms = config.get('rooms', 'practice').split()
+		self.classRooms = config.get('rooms', 'classroom').split()
+		self.teacherOnlyDays = config.getint('rooms', 'teacherOnlyDays')
+		self.openTime = getTime('rooms', 'open')
+		self.closeTime = getTime('rooms', 'close')
+
+	def isOpen(self, start, end):
+		return (self.openTime<=start.time()<=self.closeTime
+				and self.openTime<=end.time()<=self.closeTime)
+
+roomPolicy = RoomPolicy()
@@ -0,0 +1,67 @@
+# vim: set noet ts=4 sw=4 fileencoding=utf-8:
+
+'''
+微信服务器在5秒内收不到回复时会用相同的MsgId重试，最多3次。
+去重存储记录处理过的MsgId及其回复，使重试得到原来的回复，而不是重复处理。
+
+每种存储实现三个方法：
+begin(msgId)：第一次见到msgId时返回None；处理完毕时返回原来的回复；
+	正在处理时最多等待wait秒，期间处理完毕则返回其回复，否则返回''。
+	微信5秒后重试时第一次往往还在处理中，等待使这次重试就能得到回复。
+	第一次处理出错而被discard时，等待中的重试会接手处理（返回None）。
+finish(msgId, reply)：记录回复。
+discard(msgId)：处理出错时调用，使重试可以重新处理。
+'''
+
+import time
+import threading
+import collections
+
+
+class MemoryDedupStore:
+	'进程内的存储。按window秒分桶，只保留最近两个桶，因此记录保留window到2*window秒'
+	def __init__(self, window=15, wait=4.5):
+		self.window = window
+		self.wait = wait
+		self.buckets = collections.OrderedDict() # 桶序号 -> {msgId: reply，处理中为threading.Event}
+		self.lock = threading.Lock()
+
+	def find(self, msgId):
+		for bucket in self.buckets.values():
+			if msgId in bucket:
+				return bucket
+		return None
+
+	def begin(self, msgId):
+		deadline = time.monotonic() + self.wait
+		while True:
+			with self.lock:
+				current = int(time.monotonic() // self.window)
+				for index in list(self.buckets):
+					if index < current-1:
+						del self.buckets[index]
+
+				bucket = self.find(msgId)
+				if bucket is None:
+					self.buckets.setdefault(current, {})[msgId] = threading.Event()
+					return None
+				value = bucket[msgId]
+				if not isinstance(value, threading.Event):
+					return value
+			timeout = deadline - time.monotonic()
+			if timeout <= 0 or not value.wait(timeout):
+				return ''
+
+	def finish(self, msgId, reply):
+		with self.lock:
+			bucket = self.find(msgId)
+			if bucket is not None:
+				event, bucket[msgId] = bucket[msgId], reply
+				if isinstance(event, threading.Event): event.set()
+
+	def discard(self, msgId):
+		with self.lock:
+			bucket = self.find(msgId)
+			if bucket is not None:
+				event = bucket.pop(msgId)
+				if isinstance(event, threading.Event): event.set()
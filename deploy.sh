@@ -3,7 +3,8 @@
 sudo pkill uwsgi
 #cp ~/music.db .
 #sudo cp music.db db *.py *.ini *.sh *.txt /var/www/papuwx
-sudo cp db *.py *.ini *.sh *.txt /var/www/papuwx
+sudo cp -r db *.py *.ini *.sh *.txt migrations /var/www/papuwx
 cd /var/www/papuwx
 sudo chown nginx:nginx -R .
+sudo -u nginx python3 main.py db upgrade
 sudo uwsgi default.ini
@@ -0,0 +1,80 @@
+# vim: set noet ts=4 sw=4 fileencoding=utf-8:
+
+'''
+读取导入用的数据文件，只做解析，写入数据库由main中的initDb、refreshCourses和refreshShows完成。
+
+courses.txt：第一行为“学期 开始日期 结束日期”，之后每行为“周几 开始小时 结束小时 老师姓名”，例如
+	学期 2016-10-10 2017-01-11
+	周一 19 20 刘家铭
+performers.txt：每行若干个演员姓名，以空白分隔。
+旧数据库：旧版服务的sqlite文件，需事先复制到本地。
+'''
+
+import sqlite3
+import datetime
+import collections
+
+weekdayNames = '周一 周二 周三 周四 周五 周六 周日'.split()
+#预约时检查课程冲突的查询依赖这个上限
+maxCourseHours = 4
+
+CourseLine = collections.namedtuple('CourseLine', 'weekday startTime endTime teacherName')
+
+
+class DataError(ValueError):
+	pass
+
+
+def parseDate(text):
+	return datetime.datetime.strptime(text, '%Y-%m-%d').date()
+
+
+def readCourses(path):
+	'返回(开始日期, 结束日期, [CourseLine])'
+	startDate = endDate = None
+	courses = []
+	with open(path, encoding='utf8') as f:
+		for lineNo, line in enumerate(f, 1):
+			parts = line.split()
+			if not parts: continue
+			try:
+				if parts[0] == '学期':
+					startDate, endDate = parseDate(parts[1]), parseDate(parts[2])
+					continue
+				weekday, startHour, endHour, teacherName = parts
+				course = CourseLine(weekdayNames.index(weekday),
+					datetime.time(hour=int(startHour)), datetime.time(hour=int(endHour)), teacherName)
+			except (ValueError, IndexError):
+				raise DataError('{}第{}行不能识别："{}"'.format(path, lineNo, line.strip()))
+			if not 0 < course.endTime.hour - course.startTime.hour <= maxCourseHours:
+				raise DataError('{}第{}行的课程长度不在 1 到 {} 小时之间："{}"'.format(
+					path, lineNo, maxCourseHours, line.strip()))
+			courses.append(course)
+	if startDate is None:
+		raise DataError('{}中没有“学期 开始日期 结束日期”一行'.format(path))
+	if not startDate <= endDate:
+		raise DataError('{}中学期的开始日期晚于结束日期'.format(path))
+	return startDate, endDate, courses
+
+
+def readPerformers(path):
+	'返回不重复的姓名，保持文件中的顺序'
+	names = []
+	with open(path, encoding='utf8') as f:
+		for line in f:
+			names += [x for x in line.split() if x not in names]
+	return names
+
+
+def readLegacy(path):
+	'返回([(id, openId, 姓名)], [(开始, 结束, 用户id)])'
+	conn = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+	try:
+		users = conn.execute('SELECT id,openid,name FROM users_person').fetchall()
+		reservations = [(datetime.datetime.strptime(start, '%Y-%m-%d %H:%M:%S'),
+				datetime.datetime.strptime(end, '%Y-%m-%d %H:%M:%S'), personId)
+				for start, end, personId in conn.execute(
+					'SELECT start,end,person_id FROM appointment_appointment')]
+	finally:
+		conn.close()
+	return users, reservations
@@ -0,0 +1,271 @@
+#!/usr/bin/python3
+# vim: set noet ts=4 sw=4 fileencoding=utf-8:
+
+'''
+压力测试：向服务发送带签名的微信消息，按命令类型统计吞吐量、延迟和出错率。
+
+python3 loadgen.py [--target inprocess|uwsgi:/var/run/nginx/papuwx.sock|http://host/papuwx/]
+		[--mix query=4,reservation=2,cancellation=1,registration=1,voice=1,subscribe=0.2]
+		（另有recurring：每周重复的预约，默认不发送）
+		[--rate 50] [--count 1000] [--concurrency 4] [--users 100]
+
+inprocess在本进程中导入main并用Flask的测试客户端发送，会写入main.py所在目录的db，
+请在副本中先运行python3 main.py db upgrade再运行。开始前先登记--users个用户，这部分请求不计入结果。
+'''
+
+import time
+import random
+import socket
+import struct
+import hashlib
+import argparse
+import datetime
+import itertools
+import threading
+import collections
+import urllib.error
+import urllib.parse
+import urllib.request
+import concurrent.futures
+
+defaultMix = 'query=4,reservation=2,cancellation=1,registration=1,voice=1,subscribe=0.2'
+
+
+def signedQuery(token):
+	'与authenticateMessage的验证方法相同'
+	timestamp, nonce = str(int(time.time())), str(random.randrange(10**9))
+	signature = hashlib.sha1(''.join(sorted([token, timestamp, nonce])).encode('ascii')).hexdigest()
+	return urllib.parse.urlencode(dict(timestamp=timestamp, nonce=nonce, signature=signature))
+
+
+msgIds = itertools.count(int(time.time()*1000)*1000)
+
+def textBody(openId, content):
+	return ('<xml><ToUserName><![CDATA[gh_load]]></ToUserName><FromUserName><![CDATA[{}]]></FromUserName>'
+		'<CreateTime>{}</CreateTime><MsgType><![CDATA[text]]></MsgType><Content><![CDATA[{}]]></Content>'
+		'<MsgId>{}</MsgId></xml>').format(openId, int(time.time()), content, next(msgIds))
+
+def voiceBody(openId, recognition):
+	return ('<xml><ToUserName><![CDATA[gh_load]]></ToUserName><FromUserName><![CDATA[{}]]></FromUserName>'
+		'<CreateTime>{}</CreateTime><MsgType><![CDATA[voice]]></MsgType><MediaId><![CDATA[media]]></MediaId>'
+		'<Format><![CDATA[amr]]></Format><Recognition><![CDATA[{}]]></Recognition>'
+		'<MsgId>{}</MsgId></xml>').format(openId, int(time.time()), recognition, next(msgIds))
+
+def subscribeBody(openId):
+	return ('<xml><ToUserName><![CDATA[gh_load]]></ToUserName><FromUserName><![CDATA[{}]]></FromUserName>'
+		'<CreateTime>{}</CreateTime><MsgType><![CDATA[event]]></MsgType>'
+		'<Event><![CDATA[subscribe]]></Event></xml>').format(openId, int(time.time()))
+
+
+def randomSlot():
+	date = datetime.date.today() + datetime.timedelta(days=random.randrange(1, 8))
+	hour = random.randrange(8, 21)
+	return '{}月{}号'.format(date.month, date.day), hour
+
+
+class Commands:
+	'每种命令生成一组要依次发送的消息体（注册需要发送两次）'
+	def __init__(self, users):
+		self.users = ['load{}'.format(i) for i in range(users)]
+		self.newUsers = itertools.count()
+
+	def user(self):
+		return random.choice(self.users)
+
+	def query(self):
+		return [textBody(self.user(), random.choice(['查询明天', '查询这周', '查询下周', '查询我的预约']))]
+
+	def reservation(self):
+		date, hour = randomSlot()
+		return [textBody(self.user(), '预约{}{}点到{}点'.format(date, hour, hour+1))]
+
+	def recurring(self):
+		hour = random.randrange(8, 21)
+		return [textBody(self.user(), '每周{}{}点到{}点 预约两周'.format(random.choice('一二三四五六日'), hour, hour+1))]
+
+	def cancellation(self):
+		date, hour = randomSlot()
+		return [textBody(self.user(), '取消{}{}点'.format(date, hour))]
+
+	def registration(self):
+		openId = 'loadnew{}-{}'.format(int(time.time()), next(self.newUsers))
+		return [textBody(openId, '我是 {}'.format(openId)) for i in range(2)]
+
+	def voice(self):
+		return [voiceBody(self.user(), '查询明天')]
+
+	def subscribe(self):
+		return [subscribeBody(self.user())]
+
+	def warmup(self):
+		#两次发送需要不同的MsgId，否则第二次会被当作重复的消息
+		return [textBody(openId, '我是 {}'.format(openId)) for openId in self.users for i in range(2)]
+
+
+class InProcessTarget:
+	def __init__(self, token):
+		import main
+		self.client = main.app.test_client()
+		self.token = token or main.wxToken
+
+	def post(self, body):
+		'返回(状态码, 回复)。PROPAGATE_EXCEPTIONS下服务端的异常会在这里抛出'
+		r = self.client.post('/?'+signedQuery(self.token), data=body.encode('utf8'))
+		return r.status_code, r.data
+
+
+class HttpTarget:
+	def __init__(self, url, token):
+		self.url = url
+		self.token = token
+
+	def post(self, body):
+		request = urllib.request.Request('{}?{}'.format(self.url, signedQuery(self.token)),
+				body.encode('utf8'), {'Content-Type': 'text/xml'})
+		try:
+			with urllib.request.urlopen(request, timeout=30) as f:
+				return f.status, f.read()
+		except urllib.error.HTTPError as e:
+			return e.code, e.read()
+
+
+class UwsgiTarget:
+	'直接连接uwsgi的unix socket，使用uwsgi协议，不经过nginx'
+	def __init__(self, path, token, scriptName='/papuwx'):
+		self.path = path
+		self.token = token
+		self.scriptName = scriptName
+
+	def packet(self, query, body):
+		variables = dict(REQUEST_METHOD='POST', SCRIPT_NAME=self.scriptName, PATH_INFO='/',
+			REQUEST_URI='{}/?{}'.format(self.scriptName, query), QUERY_STRING=query,
+			SERVER_NAME='localhost', SERVER_PORT='80', SERVER_PROTOCOL='HTTP/1.0',
+			HTTP_HOST='localhost', CONTENT_TYPE='text/xml', CONTENT_LENGTH=str(len(body)))
+		data = b''.join(struct.pack('<H', len(x)) + x for key, value in variables.items()
+				for x in (key.encode('latin1'), value.encode('latin1')))
+		return struct.pack('<BHB', 0, len(data), 0) + data + body
+
+	def post(self, body):
+		body = body.encode('utf8')
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+			s.settimeout(30)
+			s.connect(self.path)
+			s.sendall(self.packet(signedQuery(self.token), body))
+			chunks = []
+			while True:
+				chunk = s.recv(65536)
+				if not chunk: break
+				chunks.append(chunk)
+		head, _, data = b''.join(chunks).partition(b'\r\n\r\n')
+		return int(head.split(None, 2)[1]), data
+
+
+def makeTarget(target, token):
+	if target == 'inprocess':
+		return InProcessTarget(token)
+	if target.startswith('uwsgi:'):
+		return UwsgiTarget(target[len('uwsgi:'):], token or 'bigchord')
+	return HttpTarget(target, token or 'bigchord')
+
+
+def parseMix(mix):
+	result = {}
+	for item in mix.split(','):
+		name, weight = item.split('=')
+		if not hasattr(Commands, name):
+			raise SystemExit('未知的命令类型 {}'.format(name))
+		result[name] = float(weight)
+	return result
+
+
+def percentile(sortedList, p):
+	return sortedList[min(len(sortedList)-1, int(len(sortedList)*p))]
+
+
+class Results:
+	def __init__(self):
+		self.latencies = collections.defaultdict(list)
+		self.errors = collections.Counter()
+		self.locks = collections.Counter()
+		self.lock = threading.Lock()
+
+	def add(self, name, seconds, error=None):
+		with self.lock:
+			self.latencies[name].append(seconds)
+			if error is not None:
+				self.errors[name] += 1
+				if 'locked' in error:
+					self.locks[name] += 1
+
+	def report(self, elapsed):
+		print('{:<14} {:>6} {:>8} {:>9} {:>9} {:>9} {:>7} {:>7}'.format(
+			'命令', '次数', '次/秒', 'p50 ms', 'p95 ms', 'p99 ms', '出错%', '锁%'))
+		for name in sorted(self.latencies):
+			latencies = sorted(self.latencies[name])
+			n = len(latencies)
+			print('{:<14} {:>6} {:>8.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>7.2f} {:>7.2f}'.format(
+				name, n, n/elapsed, percentile(latencies, 0.5)*1e3, percentile(latencies, 0.95)*1e3,
+				percentile(latencies, 0.99)*1e3, self.errors[name]*100/n, self.locks[name]*100/n))
+		total = sum(len(x) for x in self.latencies.values())
+		print('共 {} 个请求，{:.1f} 秒，{:.1f} 次/秒'.format(total, elapsed, total/elapsed))
+
+
+def send(target, results, name, bodies, scheduled=None):
+	"""
+	依次发送一条命令的各个请求。scheduled为按--rate安排的发送时刻：第一个请求的延迟从这个时刻算起，
+	包括在线程池中排队的时间，否则服务变慢时排队的命令不会计入延迟（coordinated omission）。
+	"""
+	for body in bodies:
+		start = scheduled or time.perf_counter()
+		scheduled = None
+		error = None
+		try:
+			status, data = target.post(body)
+			if status != 200:
+				error = '{} {}'.format(status, data[:200].decode('utf8', 'replace'))
+		except Exception as e:
+			error = '{}: {}'.format(e.__class__.__name__, e)
+		results.add(name, time.perf_counter()-start, error)
+
+
+def run(target, mix, rate, count, concurrency, users):
+	commands = Commands(users)
+	warmup = Results()
+	send(target, warmup, 'warmup', commands.warmup())
+
+	names = sorted(mix)
+	weights = [mix[x] for x in names]
+	results = Results()
+	start = time.perf_counter()
+	with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+		futures = []
+		for i in range(count):
+			scheduled = None
+			if rate > 0:
+				#按固定的到达时间发送，不因为服务变慢而降低发送速度
+				scheduled = start + i/rate
+				delay = scheduled - time.perf_counter()
+				if delay > 0: time.sleep(delay)
+			name = random.choices(names, weights)[0]
+			futures.append(pool.submit(send, target, results, name, getattr(commands, name)(), scheduled))
+		for future in futures:
+			future.result()
+	results.report(time.perf_counter() - start)
+
+
+if __name__=='__main__':
+	parser = argparse.ArgumentParser(description='向服务发送带签名的微信消息并统计延迟')
+	parser.add_argument('--target', default='inprocess',
+			help='inprocess、uwsgi:socket路径，或http://...的完整地址')
+	parser.add_argument('--token', default=None, help='微信Token，默认为main.wxToken')
+	parser.add_argument('--mix', default=defaultMix, help='命令类型=权重，逗号分隔')
+	parser.add_argument('--rate', type=float, default=0, help='每秒发送的命令数，0为尽快发送')
+	parser.add_argument('--count', type=int, default=1000, help='发送的命令数')
+	parser.add_argument('--concurrency', type=int, default=4, help='同时进行的请求数')
+	parser.add_argument('--users', type=int, default=100, help='预先登记的用户数')
+	parser.add_argument('--seed', type=int, default=None)
+	args = parser.parse_args()
+
+	random.seed(args.seed)
+	run(makeTarget(args.target, args.token), parseMix(args.mix),
+			args.rate, args.count, args.concurrency, args.users)
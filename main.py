@@ -4,35 +4,75 @@
 import os
 import sys
 import re
+import time
 import random
+import hmac
 import hashlib
+import collections
 import datetime
-import sqlite3
-from lxml import etree
+import functools
+import traceback
+import concurrent.futures
+import urllib.parse
+import urllib.request
 
-from http.client import BAD_REQUEST
+from http.client import BAD_REQUEST, NOT_FOUND
 from flask import Flask, request, abort, g
+from werkzeug.exceptions import HTTPException
 from flask_sqlalchemy import SQLAlchemy
 from flask_script import Manager
+import flask_migrate
 from flask_migrate import Migrate, MigrateCommand
+from sqlalchemy import event
+from sqlalchemy.pool import NullPool, QueuePool
 from sqlalchemy.exc import IntegrityError
 
 import patterns
 import music
-from utils import currentDate, toDatetime
+import importer
+import wxxml
+from processor import Dispatcher
+from occupancy import OccupancyIndex
+from config import config, roomPolicy, sqlitePragmas, setPragmas, commandBudgets
+from dedup import MemoryDedupStore
+from sender import StubSender, WeChatSender
+from requestlog import RequestLog
+from metrics import Metrics
+from utils import currentDate, toDatetime, TTLCache
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['PROPAGATE_EXCEPTIONS'] = True
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(
+		poolclass=dict(null=NullPool, queue=QueuePool)[config.get('database', 'pool')],
+		connect_args=dict(check_same_thread=False))
 
 wxToken = 'bigchord'
 db = SQLAlchemy(app)
+migrate = Migrate(app, db)
+event.listen(db.engine, 'connect', setPragmas(sqlitePragmas()))
+metrics = Metrics('papuwx')
+
+
+def beforeExecute(conn, cursor, statement, parameters, context, executemany):
+	#开始时刻记在每条语句各自的context上：出错的语句不会触发after_cursor_execute，记在连接上会越积越多
+	context.queryStart = time.perf_counter()
+
+
+def afterExecute(conn, cursor, statement, parameters, context, executemany):
+	'按语句类型（SELECT、INSERT等）分别记录耗时'
+	metrics.observe('sql', statement.split(None, 1)[0].upper(),
+			time.perf_counter() - context.queryStart)
+
+event.listen(db.engine, 'before_cursor_execute', beforeExecute)
+event.listen(db.engine, 'after_cursor_execute', afterExecute)
 
 class Message(db.Model):
-	'timestamp 用来实现定期清除'
+	'timestamp 用来实现定期清除。reply为处理完毕后的回复，供重试时使用'
 	msgId = db.Column(db.Integer(), primary_key=True, autoincrement=False)
 	timestamp = db.Column(db.DateTime(), default=datetime.datetime.now, nullable=False)
+	reply = db.Column(db.LargeBinary(), nullable=True)
 	def __repr__(self):
 		return '<Message {} at {}>'.format(self.msgId, self.timestamp)
 
@@ -40,7 +80,7 @@ class Message(db.Model):
 class User(db.Model):
 	id = db.Column(db.Integer(), primary_key=True)
 	openId = db.Column(db.String(), unique=True, nullable=True) #null一般为手动录入但没登记的老师
-	name = db.Column(db.String(), nullable=False)
+	name = db.Column(db.String(), nullable=False, index=True)
 	def __repr__(self):
 		return '<User {} {}>'.format(self.openId, self.name)
 
@@ -66,17 +106,34 @@ class Reservation(db.Model):
 	user = db.relationship('User', backref=db.backref('reservations', lazy='dynamic'))
 	roomId = db.Column(db.Integer(), db.ForeignKey('room.id'), nullable=False)
 	room = db.relation('Room', backref=db.backref('reservations', lazy='dynamic'))
-	start = db.Column(db.DateTime(), nullable=False)
+	start = db.Column(db.DateTime(), nullable=False, index=True)
 	end = db.Column(db.DateTime(), nullable=False)
+	__table_args__ = (db.Index('ix_reservation_userId_start', 'userId', 'start'),
+			db.Index('ix_reservation_roomId_start_end', 'roomId', 'start', 'end'))
 	def __repr__(self):
 		return '{} {}'.format(self.user.name, self.getDateRoom())
 
 	def getDateRoom(self):
-		return '{}年{}月{}日 {}:{:02}~{}:{:02} {}'.format(
-				self.start.year, self.start.month, self.start.day,
-				self.start.hour, self.start.minute,
-				self.end.hour, self.end.minute,
-				self.room.name)
+		return formatDateRoom(self.start, self.end, self.room.name)
+
+
+def formatDateRoom(start, end, roomName):
+	return '{}年{}月{}日 {}:{:02}~{}:{:02} {}'.format(
+			start.year, start.month, start.day,
+			start.hour, start.minute,
+			end.hour, end.minute,
+			roomName)
+
+
+class ReservationArchive(db.Model):
+	'开始于很久之前的预约，由maintain从reservation表移来'
+	id = db.Column(db.Integer(), primary_key=True)
+	#原来的Reservation.id。reservation表的id会在删除后被重新使用，所以不唯一
+	reservationId = db.Column(db.Integer(), nullable=False)
+	userId = db.Column(db.Integer(), db.ForeignKey('user.id'), nullable=False)
+	roomId = db.Column(db.Integer(), db.ForeignKey('room.id'), nullable=False)
+	start = db.Column(db.DateTime(), nullable=False)
+	end = db.Column(db.DateTime(), nullable=False)
 
 
 class Course(db.Model):
@@ -100,6 +157,18 @@ class Course(db.Model):
 				self.endTime.hour, self.endTime.minute)
 
 
+class CourseOccurrence(db.Model):
+	'课程规则展开后的每一次课，由refreshCourses生成'
+	id = db.Column(db.Integer(), primary_key=True)
+	courseId = db.Column(db.Integer(), db.ForeignKey('course.id'), nullable=False, index=True)
+	course = db.relation('Course', backref=db.backref('occurrences', lazy='dynamic'))
+	roomId = db.Column(db.Integer(), db.ForeignKey('room.id'), nullable=False)
+	start = db.Column(db.DateTime(), nullable=False, index=True)
+	end = db.Column(db.DateTime(), nullable=False)
+	def __repr__(self):
+		return '<CourseOccurrence {} {}>'.format(self.course, self.start.date())
+
+
 class Show(db.Model):
 	id = db.Column(db.Integer(), primary_key=True)
 	performerId = db.Column(db.Integer(), db.ForeignKey('user.id'), nullable=False)
@@ -108,6 +177,14 @@ class Show(db.Model):
 		return '<Show {}>'.format(self.performer)
 
 
+class Stamp(db.Model):
+	'数据版本号，每次写入时加一，供各进程判断自己的缓存是否过期'
+	name = db.Column(db.String(), primary_key=True)
+	value = db.Column(db.Integer(), nullable=False, default=0)
+	def __repr__(self):
+		return '<Stamp {} {}>'.format(self.name, self.value)
+
+
 class OnlineMusic(db.Model):
 	id = db.Column(db.Integer(), primary_key=True)
 	title = db.Column(db.String(), nullable=True)
@@ -116,14 +193,72 @@ class OnlineMusic(db.Model):
 		return '<OnlineMusic {} {}>'.format(self.title, self.url)
 
 
+#表结构由migrations管理（python3 main.py db upgrade），导入时不执行DDL。
+#uwsgi在导入后fork出各个worker，不能让它们共用导入时可能打开的连接
+db.engine.dispose()
+
+
+requestLog = RequestLog(config.get('log', 'path'), config.getint('log', 'maxBytes'),
+		config.getint('log', 'backupCount'), config.getfloat('log', 'sampleRate'),
+		config.get('log', 'salt'))
+
+
 appPath = '/papuwx/' if __name__=='__main__' else '/'
 @app.route(appPath, methods=['GET', 'POST'])
 def index():
-	for func in processes:
-		result = func()
-		if result is not None:
-			return result
-	return ''
+	'各个@process可以在g.log中添加字段，请求结束时写入请求日志'
+	g.log = dict(time=datetime.datetime.now().isoformat(timespec='milliseconds'))
+	start = time.perf_counter()
+	try:
+		for func in processes:
+			funcStart = time.perf_counter()
+			result = func()
+			metrics.observe('stage', func.__name__, time.perf_counter()-funcStart)
+			if result is not None:
+				return result
+		return ''
+	except HTTPException:
+		g.log['outcome'] = 'rejected'
+		raise
+	except:
+		g.log['outcome'] = 'error'
+		raise
+	finally:
+		seconds = time.perf_counter() - start
+		g.log.setdefault('outcome', 'ok')
+		g.log['latencyMs'] = round(seconds*1e3, 2)
+		requestLog.write(g.log)
+		metrics.observe('request', g.log['outcome'], seconds)
+
+
+def checkToken():
+	'运维页面需要?token=，与[metrics] token不符或未配置时当作不存在'
+	token = config.get('metrics', 'token')
+	if not token or not hmac.compare_digest(request.args.get('token', ''), token):
+		abort(NOT_FOUND)
+
+
+@app.route(appPath+'metrics')
+def metricsPage():
+	'本worker的各项耗时'
+	checkToken()
+	return metrics.format(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+@app.route(appPath+'occupancy')
+def occupancyPage():
+	'本worker占用索引的进程号、版本号、起始日期和指纹，供checkoccupancy与数据库比对'
+	checkToken()
+	index = getOccupancy()
+	return '{} {} {} {}\n'.format(os.getpid(), index.stamp, index.since.isoformat(),
+			index.fingerprint()), 200, {'Content-Type': 'text/plain'}
+
+
+def fetchPage(url):
+	'带上token访问运行中的服务，由处理该请求的worker回答'
+	url = '{}?{}'.format(url, urllib.parse.urlencode(dict(token=config.get('metrics', 'token'))))
+	with urllib.request.urlopen(url, timeout=10) as f:
+		return f.read().decode('utf8')
 
 
 processes = []
@@ -148,39 +283,96 @@ def authenticateMessage():
 def checkEcho():
 	'响应微信公众号配置页面发起的验证服务器请求'
 	if 'echostr' in request.args:
+		g.log['outcome'] = 'echo'
 		return request.args['echostr']
 
 
 @process
 def processMessage():
-	print(request.data)
-	try: e = etree.fromstring(request.data)
-	except etree.XMLSyntaxError: abort(BAD_REQUEST)
-
-	if e.findtext('MsgType').lower()=='event' and e.findtext('Event').lower()=='subscribe':
-		replyDict = dict(ToUserName=e.findtext('FromUserName'),
-			FromUserName=e.findtext('ToUserName'),
-			CreateTime=e.findtext('CreateTime'))
-		replyDict.update(recommendMusic())
-		return etree.tostring(toEtree(replyDict), encoding='utf8')
-		return etree.tostring(toEtree(dict(ToUserName=e.findtext('FromUserName'),
-			FromUserName=e.findtext('ToUserName'),
-			CreateTime=e.findtext('CreateTime'),
-			MsgType='text',
-			Content='欢迎关注钢琴社公众号\n（づ￣3￣）づ╭❤～')), encoding='utf8')
-
-	if e.findtext('MsgType') not in ('text','voice'):
+	try: e = wxxml.parseMessage(request.data)
+	except wxxml.MessageError: abort(BAD_REQUEST)
+	g.log.update(msgType=e.get('MsgType'), msgId=e.get('MsgId'),
+			openId=requestLog.hashOpenId(e.get('FromUserName')))
+
+	if e.get('MsgType', '').lower()=='event' and e.get('Event', '').lower()=='subscribe':
+		return formatReply(e.get('ToUserName'), e.get('FromUserName'), e.get('CreateTime'),
+				recommendMusic())
+		return formatReply(e.get('ToUserName'), e.get('FromUserName'), e.get('CreateTime'),
+				dict(MsgType='text', Content='欢迎关注钢琴社公众号\n（づ￣3￣）づ╭❤～'))
+
+	if e.get('MsgType') not in ('text','voice'):
+		g.log['outcome'] = 'ignored'
 		return
 
+	if e.get('MsgId') is None:
+		g.log['outcome'] = 'ignored'
+		return ''
+	msgId = int(e['MsgId'])
+	reply = dedupStore.begin(msgId)
+	if reply is not None:
+		#消息已处理，或等待之后仍在处理
+		g.log['outcome'] = 'duplicate'
+		return reply
+
 	try:
-		db.session.add(Message(msgId=int(e.findtext('MsgId'))))
+		if config.getboolean('fastack', 'enabled'):
+			replyDict = textReplyWithin(e.get('FromUserName'),
+					e.get('Content') or e.get('Recognition'))
+			#超过预算，结果稍后由replySender发出。回复success使微信不再重试
+			if replyDict is None:
+				g.log['outcome'] = 'acked'
+				reply = b'success'
+			else:
+				reply = formatReply(e.get('ToUserName'), e.get('FromUserName'), e.get('CreateTime'),
+						replyDict)
+		else:
+			reply = processText(**{x:e.get(x) for x in
+							   'ToUserName FromUserName CreateTime Content Recognition'.split()})
+		g.log['handler'] = g.get('handler')
+	except:
+		dedupStore.discard(msgId)
+		raise
+	dedupStore.finish(msgId, reply)
+	return reply
+
+
+class DbDedupStore:
+	'用Message表去重，适用于多个进程。见dedup.py，正在处理时每隔interval秒查询一次回复'
+	def __init__(self, wait=4.5, interval=0.1):
+		self.wait = wait
+		self.interval = interval
+
+	def begin(self, msgId):
+		deadline = time.monotonic() + self.wait
+		while True:
+			try:
+				db.session.add(Message(msgId=msgId))
+				db.session.commit()
+				return None
+			except IntegrityError:
+				db.session.rollback()
+			while True:
+				row = db.session.query(Message.reply).filter_by(msgId=msgId).first()
+				db.session.rollback() #结束读事务，下次查询能看到其他进程的提交
+				if row is None: break #第一次处理出错被删除，重新尝试接手
+				if row.reply is not None: return row.reply
+				if time.monotonic() >= deadline: return ''
+				time.sleep(self.interval)
+
+	def finish(self, msgId, reply):
+		Message.query.filter_by(msgId=msgId).update({Message.reply: reply})
 		db.session.commit()
-	except IntegrityError:
-		#消息已处理，或者不存在MsgId
-		return ''
 
-	return processText(**{x:e.findtext(x) for x in
-					   'ToUserName FromUserName CreateTime Content Recognition'.split()})
+	def discard(self, msgId):
+		db.session.rollback()
+		Message.query.filter_by(msgId=msgId).delete()
+		db.session.commit()
+
+
+if config.get('dedup', 'store') == 'db':
+	dedupStore = DbDedupStore(config.getfloat('dedup', 'wait'))
+else:
+	dedupStore = MemoryDedupStore(config.getint('dedup', 'window'), config.getfloat('dedup', 'wait'))
 
 
 def randomEmoji():
@@ -206,27 +398,18 @@ def randomMusic():
 	music = OnlineMusic.query[random.randrange(n)]
 	return music.url
 
-def toEtree(d, name='xml'):
-	e = etree.Element(name)
-	if isinstance(d, dict):
-		for k,v in d.items():
-			e.append(toEtree(v, name=k))
-	elif isinstance(d, tuple) or isinstance(d, list):
-		for k,v in d:
-			e.append(toEtree(v, name=k))
-	else:
-		e.text = str(d)
-	return e
+def processText(ToUserName, FromUserName, CreateTime, Content, Recognition):
+	replyDict = textReply(FromUserName, Content or Recognition)
+	return formatReply(ToUserName, FromUserName, CreateTime, replyDict)
 
 
-def processText(ToUserName, FromUserName, CreateTime, Content, Recognition):
-	g.openId = FromUserName
-	Content = Content or Recognition
+def textReply(openId, Content):
+	'处理一条文字消息，返回回复的字典'
+	g.openId = openId
+	g.handler = None
 	try:
-		for function in processText.functions:
-			replyDict = function(Content)
-			if replyDict is not None: break
-		else:
+		g.handler, replyDict = textDispatcher.dispatchWithName(Content)
+		if replyDict is None:
 			replyDict = dict(MsgType='text', Content=randomEmoji())
 			#if random.randrange(6)==0:
 			#	replyDict = dict(MsgType='text',
@@ -235,35 +418,76 @@ def processText(ToUserName, FromUserName, CreateTime, Content, Recognition):
 			#	replyDict = recommendMusic()
 	except MyException as e:
 		replyDict = dict(MsgType='text', Content=e.args[0])
+	return replyDict
 
-	reply = toEtree(dict(FromUserName=ToUserName, ToUserName=FromUserName, CreateTime=CreateTime))
-	for k,v in replyDict.items():
-		reply.append(toEtree(v, name=k))
-	result = etree.tostring(reply, encoding='utf8')
-	print(result)
-	return result
+
+def formatReply(ToUserName, FromUserName, CreateTime, replyDict):
+	'回复给发来消息的用户，因此收发双方对调'
+	return wxxml.formatReply(FromUserName, ToUserName, CreateTime, replyDict)
+
+
+if config.get('fastack', 'sender') == 'wechat':
+	replySender = WeChatSender(config.get('wechat', 'appId'), config.get('wechat', 'appSecret'))
+else:
+	replySender = StubSender()
+budgets = commandBudgets()
+replyPool = (None, None) # (pid, 线程池)。线程不会随fork复制，每个worker在第一次使用时创建
+
+
+def getReplyPool():
+	global replyPool
+	if replyPool[0] != os.getpid():
+		replyPool = (os.getpid(), concurrent.futures.ThreadPoolExecutor(config.getint('fastack', 'workers')))
+	return replyPool[1]
+
+
+def inAppContext(func, *args):
+	'在新的应用上下文中执行，同时返回其中记下的处理函数名'
+	with app.app_context():
+		return func(*args), g.get('handler')
+
+
+def sendLater(openId, future):
+	try:
+		replySender.send(openId, future.result()[0])
+	except Exception:
+		traceback.print_exc()
+
+
+def textReplyWithin(openId, Content):
+	"""
+	在线程池中处理消息，最多等待第一个前缀相符的处理函数的预算。
+	超时则返回None，处理完毕后由replySender把结果发给用户
+	"""
+	handler = next(textDispatcher.candidates(Content), None)
+	budget = budgets.get(getattr(handler, '__name__', None), config.getfloat('fastack', 'budget'))
+	future = getReplyPool().submit(inAppContext, textReply, openId, Content)
+	try:
+		replyDict, g.handler = future.result(timeout=budget)
+		return replyDict
+	except concurrent.futures.TimeoutError:
+		g.handler = getattr(handler, '__name__', None)
+		future.add_done_callback(functools.partial(sendLater, openId))
+		return None
 
 
 def recommendMusic():
-	tryCount = 10
-	nMusic = 3
-	musics = {}
-	for x in range(tryCount):
-		if len(musics)==nMusic: break
-		m = music.randomMusic()
-		musics[m['url']] = m
+	musics = music.catalog.sample(3)
 	return dict(MsgType='news',
 			ArticleCount=len(musics),
 			Articles=[('item', dict(Title=m['title'], Url=m['url'], PicUrl=m['image']))
-				for m in musics.values()])
+				for m in musics])
 
 
-def newTextFunc(func):
-	processText.__dict__.setdefault('functions',[]).append(func)
-	return func
+textDispatcher = Dispatcher()
+def newTextFunc(prefix=None):
+	'prefix为处理函数可能接受的输入的前缀正则，用于分派'
+	def decorate(func):
+		return textDispatcher.register(metrics.timed('handler')(func), prefix)
+	return decorate
 
 
-@newTextFunc
+@newTextFunc(r'\.music')
 def randMusicCommand(Content):
 	if not Content.startswith('.music'): return
 	url = 'http://www.xiami.com/song/1770656657?spm=a1z1s.3521865.23309997.11.5KmuQs'
@@ -276,17 +500,20 @@ def randMusicCommand(Content):
 		}}
 
 
-def newTextToText(func):
-	def newFunc(Content):
-		#Content = re.sub('[,，。!！?？]', '', Content.strip())
-		#if Content == '': return ''
-		replyText = func(Content.strip())
-		if replyText is None: return
-		return dict(MsgType='text', Content=replyText)
-	return newTextFunc(newFunc)
+def newTextToText(prefix=None):
+	def decorate(func):
+		@functools.wraps(func)
+		def newFunc(Content):
+			#Content = re.sub('[,，。!！?？]', '', Content.strip())
+			#if Content == '': return ''
+			replyText = func(Content.strip())
+			if replyText is None: return
+			return dict(MsgType='text', Content=replyText)
+		return newTextFunc(prefix)(newFunc)
+	return decorate
 
 
-@newTextToText
+@newTextToText(r'\.addmusic')
 def processCommand(message):
 	if message.startswith('.addmusic'):
 		parts = message.split()
@@ -304,6 +531,7 @@ def processCommand(message):
 
 def message(patternEntry):
 	def decorate(func):
+		@functools.wraps(func)
 		def newFunc(message):
 			try:
 				result = patternEntry(message)
@@ -314,7 +542,7 @@ def message(patternEntry):
 					return func(result)
 			except ValueError as e:
 				return e.args[0]
-		return newTextToText(newFunc)
+		return newTextToText(patternEntry.prefix)(newFunc)
 	return decorate
 
 
@@ -322,9 +550,27 @@ class MyException(Exception):
 	pass
 
 
+UserInfo = collections.namedtuple('UserInfo', 'id name isTeacher isPerformer')
+#只缓存已登记的用户。姓名登记后不可更改，是否教课、是否演出的变化最多延迟ttl秒
+userCache = TTLCache(maxsize=1024, ttl=600)
+
+def getUserInfo(openId):
+	userInfo = userCache.get(openId)
+	if userInfo is not None:
+		return userInfo
+	user = User.query.filter_by(openId=openId).first()
+	if user is None:
+		return None
+	userInfo = UserInfo(user.id, user.name,
+			queryExist(user.courses), queryExist(user.shows))
+	userCache.set(openId, userInfo)
+	return userInfo
+
+
 def authenticated(func):
+	@functools.wraps(func)
 	def newFunc(*args, **kwargs):
-		user = User.query.filter_by(openId=g.openId).first()
+		user = getUserInfo(g.openId)
 		if user is None:
 			raise MyException('抱歉，您还没有登记。请发送 我是xxx')
 		g.user = user
@@ -332,33 +578,120 @@ def authenticated(func):
 	return newFunc
 
 
-def overlayedReservation(start, end, room=None):
-	query = Reservation.query if room is None else room.reservations
-	return query.filter(db.or_(
-		db.and_(Reservation.start<start, Reservation.end>start), # ( [ )
-		db.and_(Reservation.start>=start, Reservation.start<end)) # [ ( ]
-	)
+def queryExist(query):
+	return len(query[:1]) > 0
 
 
-def overlayedCourse(start, end):
-	end -= datetime.timedelta(microseconds=1)
-	assert start.date() == end.date()
+def readStamp(name):
+	return db.session.query(Stamp.value).filter_by(name=name).scalar() or 0
 
-	return (Course.query.filter_by(weekday=start.weekday())
-			.filter(db.and_(Course.startDate<=start.date(),
-				Course.endDate>=start.date()))
-			.filter(db.or_(
-				db.and_(Course.startTime<start.time(), Course.endTime>start.time()),
-				db.and_(Course.startTime>=start.time(), Course.startTime<=end.time()))))
 
+def bumpStamp(name):
+	'在当前事务中把版本号加一，返回新的版本号'
+	if Stamp.query.filter_by(name=name).update({Stamp.value: Stamp.value+1}) == 0:
+		db.session.add(Stamp(name=name, value=1))
+		db.session.flush()
+	return readStamp(name)
 
-def queryExist(query):
-	return len(query[:1]) > 0
+
+def reservationRepr(start, end, userName):
+	return '{:02}:{:02}~{:02}:{:02} {}'.format(start.hour, start.minute,
+			end.hour, end.minute, userName)
+
+
+def courseRepr(x):
+	return '{:02}:{:02}~{:02}:{:02} {}*'.format(x.startTime.hour, x.startTime.minute,
+			x.endTime.hour, x.endTime.minute, x.teacher.name)
+
+
+def activeReservations(user):
+	'尚未开始的预约'
+	return (Reservation.query.filter_by(userId=user.id)
+			.filter(Reservation.start>datetime.datetime.now()))
+
+
+def reservationsAt(user, time, room=None):
+	'time时刻正在进行的预约'
+	query = Reservation.query.filter_by(userId=user.id)
+	if room is not None:
+		query = query.filter_by(roomId=room.id)
+	return query.filter(db.and_(Reservation.start<=time, time<Reservation.end))
+
+
+def reservationsSince(since):
+	return (Reservation.query.options(db.joinedload(Reservation.user))
+			.filter(Reservation.start>=toDatetime(since)))
+
+
+def courseOccurrencesSince(since):
+	return (CourseOccurrence.query
+			.options(db.joinedload(CourseOccurrence.course).joinedload(Course.teacher))
+			.filter(CourseOccurrence.start>=toDatetime(since)))
+
+
+occupancyIndex = None
+
+def loadOccupancy(since=None):
+	'从数据库建立since之后的占用索引。先读版本号，这样期间的写入最多导致多加载一次'
+	since = since or currentDate()
+	index = OccupancyIndex(since, readStamp('occupancy'))
+	for x in reservationsSince(since):
+		index.addReservation(x.id, x.roomId, x.start, x.end,
+				reservationRepr(x.start, x.end, x.user.name))
+	for x in courseOccurrencesSince(since):
+		index.addCourse(x.roomId, x.start, x.end, courseRepr(x.course))
+	return index
+
+
+def getOccupancy(date=None):
+	'返回本进程的占用索引，数据库版本号变化（其他进程有写入）时重新加载'
+	global occupancyIndex
+	since = min(currentDate(), date or currentDate())
+	if (occupancyIndex is None or occupancyIndex.since > since
+			or occupancyIndex.stamp != readStamp('occupancy')):
+		occupancyIndex = loadOccupancy(since)
+	return occupancyIndex
+
+
+def updateOccupancy(stamp, update):
+	"""
+	本进程写入并提交后，用update(index)同步更新索引。
+	如果期间还有其他进程写入，则不更新，等下次使用时重新加载。
+	"""
+	if occupancyIndex is not None and occupancyIndex.stamp == stamp-1:
+		update(occupancyIndex)
+		occupancyIndex.stamp = stamp
+
+
+def checkOccupancy(url, count=20):
+	"""
+	多次请求url（运行中服务的occupancy页面），把回答的各个worker的索引指纹与从数据库加载的比对，
+	返回[(进程号, 版本号, 指纹, 结果)]。每个worker只比对最后一次回答；
+	版本号与数据库不同说明期间有写入，无法比对，需要重新运行。
+	"""
+	workers = {}
+	for i in range(count):
+		pid, stamp, since, fingerprint = fetchPage(url).split()
+		workers[pid] = (int(stamp), datetime.datetime.strptime(since, '%Y-%m-%d').date(), fingerprint)
+	loaded = {}
+	results = []
+	for pid, (stamp, since, fingerprint) in sorted(workers.items()):
+		if since not in loaded:
+			loaded[since] = loadOccupancy(since)
+		index = loaded[since]
+		if index.stamp != stamp:
+			result = 'changed (db stamp {})'.format(index.stamp)
+		elif index.fingerprint() != fingerprint:
+			result = 'mismatch (db {})'.format(index.fingerprint())
+		else:
+			result = 'ok'
+		results.append((pid, stamp, fingerprint, result))
+	return results
 
 
 @message(patterns.iAm)
 def processRegistration(name):
-	user = User.query.filter_by(openId=g.openId).first()
+	user = getUserInfo(g.openId)
 	if user is not None:
 		if user.name == name:
 			return '您已设置姓名为 {}'.format(name)
@@ -383,145 +716,298 @@ def processRegistration(name):
 			db.session.add(User(openId=g.openId, name=name))
 		db.session.delete(registration)
 		db.session.commit()
+		userCache.pop(g.openId)
 		return '您已设置姓名为 {}'.format(name)
 
 
+RoomInfo = collections.namedtuple('RoomInfo', 'id name')
+roomCatalog = None
+
+def getRooms():
+	'本进程缓存的全部房间，{小写名称: RoomInfo}。房间只在initDb时创建，之后进程会重新启动'
+	global roomCatalog
+	if roomCatalog is None:
+		roomCatalog = {x.name.lower(): RoomInfo(x.id, x.name) for x in Room.query}
+	return roomCatalog
+
+
+def invalidateRooms():
+	global roomCatalog
+	roomCatalog = None
+
+
 def getRoom(roomName):
-	room = Room.query.filter_by(name=roomName).first()
+	room = getRooms().get(roomName.lower())
 	if room is None:
 		raise MyException('没有找到 {} 琴房'.format(roomName))
 	return room
 
 
+maxActiveReservations = 2
+
+
+maxReservationLength = datetime.timedelta(hours=2)
+maxCourseLength = datetime.timedelta(hours=importer.maxCourseHours)
+
+
+def overlayedIn(model, start, end, maxLength):
+	"""
+	与start~end重叠，判断同occupancy.overlaps。
+	model中的时段都不超过maxLength，所以第一种情况只需查找start-maxLength之后开始的，两种情况都是start上的范围查找
+	"""
+	return db.or_(db.and_(start-maxLength<model.start, model.start<start, model.end>start),
+			db.and_(start<=model.start, model.start<end))
+
+
+def reservationsOverlayed(roomId, slots):
+	'roomId中与slots的任一时段重叠的预约'
+	return Reservation.query.filter(Reservation.roomId==roomId,
+			db.or_(*[overlayedIn(Reservation, start, end, maxReservationLength) for start, end in slots]))
+
+
+def coursesOverlayed(slots):
+	'任意房间中与slots的任一时段重叠的课'
+	return CourseOccurrence.query.filter(
+			db.or_(*[overlayedIn(CourseOccurrence, start, end, maxCourseLength) for start, end in slots]))
+
+
+def addReservation(room, start, end, checkCourse=False):
+	'添加一个预约，见addReservations'
+	result = addReservations(room, [(start, end)], checkCourse)
+	return result and result[0]
+
+
+def addReservations(room, slots, checkCourse=False):
+	"""
+	添加slots中的全部(开始, 结束)并同步更新本进程的占用索引，返回各个预约的描述。
+	没有重叠的预约（checkCourse时还要没有课）、加上这些预约后活跃预约数不超过上限这两个条件和插入写在同一条
+	INSERT ... SELECT中，sqlite在写语句开始时就取得写锁，所以另一个进程不能在检查之后、插入之前抢先预约。
+	任何一个时段不满足条件时一个也不插入，返回None
+	"""
+	conditions = [
+		~reservationsOverlayed(room.id, slots).exists(),
+		db.select([db.func.count()]).where(db.and_(Reservation.userId==g.user.id,
+			Reservation.start>datetime.datetime.now())).as_scalar() + len(slots) <= maxActiveReservations,
+	]
+	if checkCourse:
+		conditions.append(~coursesOverlayed(slots).exists())
+	values = [db.select([db.literal(g.user.id), db.literal(room.id),
+			db.literal(start, db.DateTime), db.literal(end, db.DateTime)]).where(db.and_(*conditions))
+			for start, end in slots]
+	result = db.session.execute(Reservation.__table__.insert().from_select(
+			['userId', 'roomId', 'start', 'end'], values[0] if len(values)==1 else db.union_all(*values)))
+	#条件对每个时段都相同，结果是全部插入或全不插入；行数不符时也整体回滚
+	if result.rowcount != len(slots):
+		db.session.rollback()
+		return None
+
+	stamp = bumpStamp('occupancy')
+	if len(slots) == 1:
+		entries = [(result.lastrowid,) + slots[0]]
+	else:
+		entries = (db.session.query(Reservation.id, Reservation.start, Reservation.end)
+				.filter_by(userId=g.user.id, roomId=room.id)
+				.filter(Reservation.start.in_([start for start, end in slots])).all())
+	db.session.commit()
+	def update(index):
+		for theId, start, end in entries:
+			index.addReservation(theId, room.id, start, end, reservationRepr(start, end, g.user.name))
+	updateOccupancy(stamp, update)
+	return [formatDateRoom(start, end, room.name) for start, end in slots]
+
+
 @message(patterns.reservation)
 @authenticated
 def processReservation(start, end, roomName):
-	if 0 and not queryExist(g.user.shows) and not queryExist(g.user.courses):
+	if 0 and not g.user.isPerformer and not g.user.isTeacher:
 		return '抱歉，在5月21日演奏会之前，只有演员可以预约'
 
 	if 1 and (start.month,start.day)==(6,4):
 		return randomEmojiLink(emoji='\U0001F1E8\U0001F1F3', link='http://www.xiami.com/song/3598817')
 
-	#活跃预约数不超过2
-	nActiveReservations = (Reservation.query.filter_by(user=g.user)
-			.filter(Reservation.start>datetime.datetime.now()).count())
-	if nActiveReservations >= 2:
-		return '抱歉，每人最多持有 2 个预约。如需添加新的预约，请取消至少一个预约。'
+	#活跃预约数不超过2。这里只是提前回复，插入时还会再检查
+	quotaMessage = '抱歉，每人最多持有 2 个预约。如需添加新的预约，请取消至少一个预约。'
+	if activeReservations(g.user).count() >= maxActiveReservations:
+		return quotaMessage
 
 	#时长不超过2小时
-	if (end-start).seconds > 2*3600:
+	if end-start > maxReservationLength:
 		return '抱歉，单次预约时长不能超过 2 个小时。'
 
 	room = None if roomName is None else getRoom(roomName)
-	classRoom = Room.query.filter_by(name='B253').first()
-	practiceRooms = [Room.query.filter_by(name=x).first() for x in ['B252', 'B250']]
+	classRooms = [getRoom(x) for x in roomPolicy.classRooms]
+	practiceRooms = [getRoom(x) for x in roomPolicy.practiceRooms]
+	occupancy = getOccupancy(start.date())
 
 	for x in [0]:
 		roomFound = False
 
 		for practiceRoom in practiceRooms:
 			if room is None or room==practiceRoom:
-				isIdle = not queryExist(overlayedReservation(start, end, practiceRoom))
+				isIdle = not occupancy.overlayedReservation(practiceRoom.id, start, end)
 				if isIdle:
-					reservation = Reservation(user=g.user, room=practiceRoom, start=start, end=end)
-					db.session.add(reservation)
-					db.session.commit()
-					roomFound = True
-					break
+					reservation = addReservation(practiceRoom, start, end)
+					roomFound = reservation is not None
+					if roomFound: break
 		if roomFound: break
 
-		if room is None or room==classRoom:
-			#在本学期有课还没上完的时候，只有老师可以预约两天之后的classRoom
-			if not ((queryExist(g.user.courses) #是老师
-				or (start.date()-datetime.datetime.now().date()).days <= 2)):
-				return '抱歉，只有教课的老师可以预约超过 2 天之后的 {}'.format(classRoom.name)
+		for classRoom in classRooms:
+			if room is None or room==classRoom:
+				#在本学期有课还没上完的时候，只有老师可以预约若干天之后的classRoom
+				if not ((g.user.isTeacher
+					or (start.date()-datetime.datetime.now().date()).days <= roomPolicy.teacherOnlyDays)):
+					return '抱歉，只有教课的老师可以预约超过 {} 天之后的 {}'.format(
+							roomPolicy.teacherOnlyDays, classRoom.name)
 
-			#没有课
-			isIdle = not queryExist(overlayedCourse(start,end))
-			#没有预约
-			isIdle = isIdle and not queryExist(overlayedReservation(start,end,classRoom))
+				#没有课
+				isIdle = not occupancy.overlayedCourse(start, end)
+				#没有预约
+				isIdle = isIdle and not occupancy.overlayedReservation(classRoom.id, start, end)
 
-			if isIdle:
-				reservation = Reservation(user=g.user, room=classRoom, start=start, end=end)
-				db.session.add(reservation)
-				db.session.commit()
-				break
+				if isIdle:
+					reservation = addReservation(classRoom, start, end, checkCourse=True)
+					roomFound = reservation is not None
+					if roomFound: break
+		if roomFound: break
 	else:
+		#插入失败可能是因为其他进程中同一用户的预约抢先占满了名额
+		if activeReservations(g.user).count() >= maxActiveReservations:
+			return quotaMessage
 		if room is None: return '此时段预约已满'
 		else: return '此时段的 {} 预约已满'.format(room.name)
 
-	result = '您已预约 {}'.format(reservation.getDateRoom())
-	t1,t2 = datetime.time(hour=8), datetime.time(hour=22, minute=30)
-	if not (t1<=reservation.start.time()<=t2 and t1<=reservation.end.time()<=t2):
+	result = '您已预约 {}'.format(reservation)
+	if not roomPolicy.isOpen(start, end):
 		result += '\n警告：此时段琴房可能不开'
 	return result
 
 
+@message(patterns.recurringReservation)
+@authenticated
+def processRecurringReservation(start, end, weeks, roomName):
+	"""
+	在同一个房间预约连续weeks周的同一时段，全部成功或全部失败。
+	各项限制与processReservation相同，活跃预约数上限对这些预约合计计算
+	"""
+	now = datetime.datetime.now()
+	if start < now:
+		start, end = start + datetime.timedelta(days=7), end + datetime.timedelta(days=7)
+	slots = [(start + datetime.timedelta(days=7*i), end + datetime.timedelta(days=7*i))
+			for i in range(weeks)]
+
+	quotaMessage = '抱歉，每人最多持有 {} 个预约，您目前持有 {} 个，不能再预约 {} 次。'
+	active = activeReservations(g.user).count()
+	if active + weeks > maxActiveReservations:
+		return quotaMessage.format(maxActiveReservations, active, weeks)
+
+	if end-start > maxReservationLength:
+		return '抱歉，单次预约时长不能超过 2 个小时。'
+
+	room = None if roomName is None else getRoom(roomName)
+	classRooms = [getRoom(x) for x in roomPolicy.classRooms]
+	practiceRooms = [getRoom(x) for x in roomPolicy.practiceRooms]
+	occupancy = getOccupancy(start.date())
+	#最后一次在teacherOnlyDays之内，则每一次都在之内
+	classRoomAllowed = (g.user.isTeacher
+			or (slots[-1][0].date()-now.date()).days <= roomPolicy.teacherOnlyDays)
+
+	reservations = None
+	for candidate in practiceRooms + classRooms:
+		if room is not None and room != candidate: continue
+		isClassRoom = candidate in classRooms
+		if isClassRoom and not classRoomAllowed:
+			return '抱歉，只有教课的老师可以预约超过 {} 天之后的 {}'.format(
+					roomPolicy.teacherOnlyDays, candidate.name)
+		isIdle = all(not occupancy.overlayedReservation(candidate.id, x, y)
+				and not (isClassRoom and occupancy.overlayedCourse(x, y)) for x, y in slots)
+		if isIdle:
+			reservations = addReservations(candidate, slots, checkCourse=isClassRoom)
+			if reservations is not None: break
+
+	if reservations is None:
+		active = activeReservations(g.user).count()
+		if active + weeks > maxActiveReservations:
+			return quotaMessage.format(maxActiveReservations, active, weeks)
+		return '{}起连续 {} 周的此时段{}预约已满'.format(formatDate(start.date()), weeks,
+				'' if room is None else '的 {} '.format(room.name))
+
+	result = '您已预约\n{}'.format('\n'.join(reservations))
+	if not all(roomPolicy.isOpen(x, y) for x, y in slots):
+		result += '\n警告：有的时段琴房可能不开'
+	return result
+
+
 @message(patterns.cancellation)
 @authenticated
 def processCancellation(time, roomName):
-	query = Reservation.query.filter_by(user=g.user)
-	if roomName is not None:
-		query = query.filter_by(room=getRoom(roomName))
-	reservations = query.filter(db.and_(Reservation.start<=time, time<Reservation.end))
-	resultList = [r.getDateRoom() for r in reservations]
+	room = None if roomName is None else getRoom(roomName)
+	reservations = reservationsAt(g.user, time, room)
+	reservationIds = []
+	resultList = []
+	for r in reservations:
+		reservationIds.append(r.id)
+		resultList.append(r.getDateRoom())
 	if len(resultList)==0:
 		return '您没有预约{}年{}月{}日{}:{:02}的{}'.format(
 				time.year, time.month, time.day,
 				time.hour, time.minute,
 				'琴房' if roomName is None else roomName)
 	reservations.delete()
+	stamp = bumpStamp('occupancy')
 	db.session.commit()
+	def update(index):
+		for theId in reservationIds:
+			index.removeReservation(theId)
+	updateOccupancy(stamp, update)
 	return '您已取消{}{}'.format('\n'*(len(resultList)>1), '\n'.join(resultList))
 
 
 @message(patterns.queryMyself)
 @authenticated
 def processQueryMyself():
-	reservations = (g.user.reservations.filter(datetime.datetime.now()<Reservation.start)
-			.order_by(Reservation.start))
+	reservations = activeReservations(g.user).order_by(Reservation.start)
 	resultList = [r.getDateRoom() for r in reservations]
 	if len(resultList)==0:
 		return '您目前没有预约'
 	return '您的预约:{}{}'.format('\n'*(len(resultList)>1), '\n'.join(resultList))
 
 
-def queryOccupations(date):
-	start, end = toDatetime(date), toDatetime(date+datetime.timedelta(days=1))
-	reservations = [dict(
-		room = x.room.id,
-		start = x.start.time(),
-		end = x.end.time(),
-		repr = '{:02}:{:02}~{:02}:{:02} {}'.format(x.start.hour, x.start.minute,
-			x.end.hour, x.end.minute, x.user.name),
-		) for x in overlayedReservation(start, end)]
-
-	courses = [dict(
-		room = x.room.id,
-		start = x.startTime,
-		end = x.endTime,
-		repr = '{:02}:{:02}~{:02}:{:02} {}*'.format(x.startTime.hour, x.startTime.minute,
-			x.endTime.hour, x.endTime.minute, x.teacher.name)
-		) for x in overlayedCourse(start, end)]
-
-	return (reservations, courses)
-
-
 def formatDate(date):
 	return '{}年{}月{}日'.format(date.year, date.month, date.day)
 
 
-def formatReservation(date, reservations, courses):
+def formatReservation(date, reservations, courses, roomNames):
 	dateRepr = formatDate(date)
 	resultList = reservations + courses
 	resultList.sort(key=lambda x:(x['room'], x['start'], x['end']))
 	resultRepr = '{}：'.format(dateRepr)
 	for i,x in enumerate(resultList):
 		if i==0 or x['room']!=resultList[i-1]['room']:
-			resultRepr += '\n'*(i>0) + '\n[{}]'.format(Room.query.get(x['room']).name)
+			resultRepr += '\n'*(i>0) + '\n[{}]'.format(roomNames[x['room']])
 		resultRepr += '\n{}'.format(x['repr'])
 	return resultRepr
 
+def renderDay(occupancy, date):
+	'(当天的回复文字, 是否有课)，没有预约和课程时文字为None'
+	reservations, courses = occupancy.occupations(date)
+	if len(reservations) + len(courses) == 0:
+		return (None, False)
+	roomNames = {x.id: x.name for x in getRooms().values()}
+	return (formatReservation(date, reservations, courses, roomNames), len(courses) > 0)
+
+
+def queryDayBlocks(startDate, endDate):
+	"""
+	startDate至endDate（不含）每天的(日期, 文字, 是否有课)。
+	所有日期共用一次索引检查。文字按日期缓存在占用索引中：本进程的预约、取消只丢弃相应日期，
+	其他进程的写入和refreshCourses会改变数据库的版本号，使整个索引连同缓存重新加载
+	"""
+	occupancy = getOccupancy(startDate)
+	return [(date,) + occupancy.rendered(date, lambda date: renderDay(occupancy, date))
+			for date in (startDate + datetime.timedelta(days=i)
+				for i in range((endDate - startDate).days))]
+
+
 @message(patterns.query)
 @authenticated
 def processQuery(start, end):
@@ -532,15 +1018,12 @@ def processQuery(start, end):
 
 	hasCourse = False
 	result = []
-	for i in range((end.date() - start.date()).days):
-		date = start.date() + datetime.timedelta(days=i)
-		reservations, courses = queryOccupations(date)
-
-		if len(reservations) + len(courses) == 0:
+	for date, block, dayHasCourse in queryDayBlocks(start.date(), end.date()):
+		if block is None:
 			continue
 
-		result.append(formatReservation(date, reservations, courses))
-		hasCourse = hasCourse or len(courses) > 0
+		result.append(block)
+		hasCourse = hasCourse or dayHasCourse
 
 	if len(result)==0:
 		intervalRepr = formatDate(start.date())
@@ -555,110 +1038,364 @@ def processQuery(start, end):
 	return '\n\n'.join(result)
 
 
-def initDb():
+def ceilTime(time, minutes):
+	'向上取整到minutes分钟的整数倍'
+	step = minutes*60
+	seconds = (time - toDatetime(time.date())).total_seconds()
+	return toDatetime(time.date()) + datetime.timedelta(seconds=-(-seconds//step)*step)
+
+
+@message(patterns.freeSlots)
+@authenticated
+def processFreeSlots(startDate, endDate, section, duration):
+	'各房间在琴房开放时间内、至少duration长的空闲时段，房间的规则与processReservation相同'
+	now = datetime.datetime.now()
+	classRooms = [getRoom(x) for x in roomPolicy.classRooms]
+	practiceRooms = [getRoom(x) for x in roomPolicy.practiceRooms]
+	occupancy = getOccupancy(startDate)
+
+	result = []
+	date = startDate
+	while date < endDate:
+		start = datetime.datetime.combine(date, roomPolicy.openTime)
+		end = datetime.datetime.combine(date, roomPolicy.closeTime)
+		if section is not None:
+			start = max(start, datetime.datetime.combine(date, section[0]))
+			end = min(end, ceilTime(datetime.datetime.combine(date, section[1]), 1))
+		if date == now.date():
+			start = max(start, ceilTime(now, 15))
+
+		rooms = [(x, False) for x in practiceRooms]
+		if g.user.isTeacher or (date-now.date()).days <= roomPolicy.teacherOnlyDays:
+			rooms += [(x, True) for x in classRooms]
+		lines = []
+		for room, withCourses in rooms:
+			free = [x for x in occupancy.freeIntervals(room.id, start, end, withCourses)
+					if x[1]-x[0] >= duration]
+			if free:
+				lines.append('[{}] {}'.format(room.name, '，'.join('{}:{:02}~{}:{:02}'.format(
+					x[0].hour, x[0].minute, x[1].hour, x[1].minute) for x in free)))
+		if lines:
+			result.append('{}：\n{}'.format(formatDate(date), '\n'.join(lines)))
+		date += datetime.timedelta(days=1)
+
+	if len(result)==0:
+		intervalRepr = formatDate(startDate)
+		if endDate - startDate > datetime.timedelta(days=1):
+			intervalRepr += '至' + formatDate(endDate - datetime.timedelta(days=1))
+		return '{}没有{}分钟以上的空闲时段'.format(intervalRepr, int(duration.total_seconds()//60))
+	return '\n\n'.join(result)
+
+
+def hotQueries():
+	'处理消息时会执行的查询，供checkPlans检查'
+	user = User(id=0)
+	room = Room(id=0)
+	now = datetime.datetime.now()
+	return [
+		('authenticated', User.query.filter_by(openId='')),
+		('processRegistration', Registration.query.filter_by(openId='')),
+		('getCreateUsers', db.session.query(User.id, User.name).filter(User.name.in_(['', '']))),
+		('readStamp', db.session.query(Stamp.value).filter_by(name='')),
+		('activeReservations', activeReservations(user)),
+		('processQueryMyself', activeReservations(user).order_by(Reservation.start)),
+		('processCancellation', reservationsAt(user, now)),
+		('processCancellation room', reservationsAt(user, now, room)),
+		('addReservations', reservationsOverlayed(0, [(now, now+datetime.timedelta(hours=1))])),
+		('addReservations courses', coursesOverlayed([(now, now+datetime.timedelta(hours=1))])),
+		('reservationsSince', reservationsSince(now.date())),
+		('courseOccurrencesSince', courseOccurrencesSince(now.date())),
+		('refreshCourses occurrences', CourseOccurrence.query.filter_by(courseId=0)),
+	]
+
+
+def explainQuery(query):
+	compiled = query.with_labels().statement.compile(dialect=db.engine.dialect)
+	params = [compiled.params[x] for x in compiled.positiontup]
+	return [row[-1] for row in db.engine.execute('EXPLAIN QUERY PLAN '+str(compiled), params)]
+
+
+def checkPlans():
+	'返回[(名称, 查询计划, 是否使用了全表扫描)]'
+	result = []
+	for name, query in hotQueries():
+		plan = explainQuery(query)
+		fullScan = any(re.match(r'SCAN (TABLE )?\w+$', x) for x in plan)
+		result.append((name, plan, fullScan))
+	return result
+
+
+def purgeMessages(before, batchSize):
+	'分批删除before之前的Message，每批一个事务，返回删除的行数'
+	count = 0
+	while True:
+		ids = [x for x, in db.session.query(Message.msgId)
+				.filter(Message.timestamp<before).limit(batchSize)]
+		if len(ids) == 0: break
+		Message.query.filter(Message.msgId.in_(ids)).delete(synchronize_session=False)
+		db.session.commit()
+		count += len(ids)
+	return count
+
+
+def archiveReservations(before, batchSize):
+	'分批把before之前开始的预约移到reservation_archive，每批一个事务，返回移动的行数'
+	count = 0
+	while True:
+		reservations = (Reservation.query.filter(Reservation.start<before)
+				.order_by(Reservation.start).limit(batchSize).all())
+		if len(reservations) == 0: break
+		for x in reservations:
+			db.session.add(ReservationArchive(reservationId=x.id, userId=x.userId, roomId=x.roomId,
+				start=x.start, end=x.end))
+		(Reservation.query.filter(Reservation.id.in_([x.id for x in reservations]))
+				.delete(synchronize_session=False))
+		db.session.commit()
+		count += len(reservations)
+	return count
+
+
+def maintain():
+	'清理过期的Message，归档过去的预约。返回[(名称, 行数, 秒数)]'
+	now = datetime.datetime.now()
+	batchSize = config.getint('maintenance', 'batchSize')
+	reservationDays = max(1, config.getint('maintenance', 'reservationDays')) #今天的预约在占用索引中
+	tasks = [
+		('purgeMessages', lambda: purgeMessages(
+			now - datetime.timedelta(days=config.getint('maintenance', 'messageDays')), batchSize)),
+		('archiveReservations', lambda: archiveReservations(
+			toDatetime(currentDate() - datetime.timedelta(days=reservationDays)), batchSize)),
+	]
+	result = []
+	for name, task in tasks:
+		t = time.perf_counter()
+		count = task()
+		result.append((name, count, time.perf_counter()-t))
+	return result
+
+
+def formatMaintenance(result):
+	return '\n'.join('{} {} rows {:.3f}s'.format(*x) for x in result)
+
+
+try:
+	import uwsgidecorators
+except ImportError:
+	uwsgidecorators = None
+
+if uwsgidecorators is not None and config.getint('maintenance', 'interval') > 0:
+	#由uwsgi的master定时通知一个worker执行，需要master = true
+	@uwsgidecorators.timer(config.getint('maintenance', 'interval'))
+	def maintenanceTimer(signum):
+		with app.app_context():
+			print(formatMaintenance(maintain()))
+
+
+def initDb(legacyPath=None):
+	"""
+	重建数据库。legacyPath为旧版服务的数据库文件，需事先复制到本地，例如
+	scp hsw@115.159.82.217:/var/www/papuwx/db.sqlite3 db.legacy
+	所有数据在同一个事务中批量插入。返回课程和演出的变化
+	"""
 	try: os.remove('db')
 	except OSError: pass
 
 	db.create_all()
+	with app.app_context():
+		flask_migrate.stamp() #新建的数据库已包含所有索引
 
 	#room
-	B252 = Room(name='B252')
-	B253 = Room(name='B253')
-	db.session.add(B252)
-	db.session.add(B253)
-
-	#legacy db
-	legacyName = 'db.legacy'
-	try: os.remove(legacyName)
-	except OSError: pass
-	print('fetching legacy db ...')
-	statusCode = os.system('scp hsw@115.159.82.217:/var/www/papuwx/db.sqlite3 {}'.format(legacyName))
-	if statusCode != 0:
-		raise RuntimeError('error while fetching legacy db')
-	conn = sqlite3.connect(legacyName)
-
-	#legacy users
-	curs = conn.cursor()
-	curs.execute('SELECT id,openid,name FROM users_person')
-	users = {}
-	for theId, openId, name in curs:
-		user = User(openId=openId, name=name)
-		users[theId] = user
-		db.session.add(user)
-	
-	#legacy reservations
-	curs=conn.cursor()
-	curs.execute('SELECT start,end,person_id FROM appointment_appointment')
-	practiceRoom, classRoom = Room.query.order_by(Room.id)
-	for start, end, personId in curs:
-		user = users[personId]
-		start = datetime.datetime.strptime(start, '%Y-%m-%d %H:%M:%S')
-		end = datetime.datetime.strptime(end, '%Y-%m-%d %H:%M:%S')
-		reservation = Reservation(user=user, start=start, end=end, room=practiceRoom)
-		db.session.add(reservation)
-
-	conn.close()
-	try: os.remove(legacyName)
-	except OSError: pass
-
-	refreshCourses()
-
-	#show
-	for line in open('performers.txt'):
-		performerNames = line.split()
-		for performerName in performerNames:
-			user = getCreateUser(performerName)
-			show = Show(performer=user)
-			db.session.add(show)
-
+	for roomName in roomPolicy.practiceRooms + roomPolicy.classRooms:
+		db.session.add(Room(name=roomName))
+	db.session.flush()
+	invalidateRooms()
+
+	if legacyPath is not None:
+		users, reservations = importer.readLegacy(legacyPath)
+		#addReservations的冲突检查假定预约不超过maxReservationLength，过去的预约不会与新的冲突
+		now = datetime.datetime.now()
+		if any(end > now and end-start > maxReservationLength for start, end, personId in reservations):
+			raise importer.DataError('{}中有尚未结束、超过 2 小时的预约'.format(legacyPath))
+		#新数据库是空的，沿用旧的用户id
+		if users:
+			db.session.execute(User.__table__.insert(),
+					[dict(id=theId, openId=openId, name=name) for theId, openId, name in users])
+		practiceRoom = getRoom(roomPolicy.practiceRooms[0])
+		if reservations:
+			db.session.execute(Reservation.__table__.insert(),
+					[dict(userId=personId, roomId=practiceRoom.id, start=start, end=end)
+						for start, end, personId in reservations])
+
+	changes = refreshCourses() + refreshShows()
 	db.session.commit()
+	return changes
+
+
+def getCreateUsers(names):
+	"""
+	一次查询取得已有的用户，没有的一次插入。同名的用户取id最小的一个。
+	返回({姓名: id}, [新建的用户姓名])
+	"""
+	names = set(names)
+	userIds = {}
+	def lookup(names):
+		for theId, name in (db.session.query(User.id, User.name)
+				.filter(User.name.in_(names)).order_by(User.id.desc())):
+			userIds[name] = theId
+	lookup(names)
+	newNames = sorted(names - set(userIds))
+	if newNames:
+		db.session.execute(User.__table__.insert(), [dict(name=x) for x in newNames])
+		lookup(newNames)
+	return userIds, newNames
+
+
+def courseKey(course):
+	return (course.teacherId, course.roomId, course.weekday,
+			course.startDate, course.endDate, course.startTime, course.endTime)
+
+
+def occurrenceRows(course):
+	'把每周的课程规则展开成startDate~endDate间的每一次课，返回供批量插入的行'
+	rows = []
+	date = course.startDate + datetime.timedelta(days=(course.weekday-course.startDate.weekday())%7)
+	while date <= course.endDate:
+		rows.append(dict(courseId=course.id, roomId=course.roomId,
+			start=datetime.datetime.combine(date, course.startTime),
+			end=datetime.datetime.combine(date, course.endTime)))
+		date += datetime.timedelta(days=7)
+	return rows
 
 
 def refreshCourses():
-	B252 = getRoom('B252')
-	B253 = getRoom('B253')
-	Course.query.delete()
-	for line in open('courses.txt'):
-		weekday, startHour, endHour, teacherName = line.split()
-		print(weekday, startHour, endHour, teacherName)
-		weekday = '周一 周二 周三 周四 周五 周六 周日'.split().index(weekday)
-		startTime = datetime.time(hour=int(startHour))
-		endTime = datetime.time(hour=int(endHour))
-		startDate = datetime.date(year=2016, month=10, day=10)
-		endDate = datetime.date(year=2017, month=1, day=11)
-		teacher = getCreateUser(teacherName)
-		room = B253
-		course = Course(teacher=teacher, room=room, weekday=weekday,
-				startDate=startDate, endDate=endDate, startTime=startTime, endTime=endTime)
-		db.session.add(course)
-		db.session.commit()
-
-def getCreateUser(name):
-	print('getting', name)
-	user = User.query.filter_by(name=name)
-	print(user)
-	user = user.first()
-	if user is None:
-		user = User(name=name)
-		db.session.add(user)
+	"""
+	按courses.txt增量更新课程：删除文件中已没有的课程及其展开的每一次课，
+	添加新的课程并展开，没有变化的课程保持不动。学期的起止日期也由courses.txt给出。
+	不提交，返回变化的描述，由调用者提交或（试运行时）回滚。
+	"""
+	startDate, endDate, lines = importer.readCourses('courses.txt')
+	classRoom = getRoom(roomPolicy.classRooms[0])
+	teacherIds, newTeachers = getCreateUsers(x.teacherName for x in lines)
+	changes = ['+ 用户 {}'.format(x) for x in newTeachers]
+
+	courses = {}
+	for x in lines:
+		course = Course(teacherId=teacherIds[x.teacherName], roomId=classRoom.id, weekday=x.weekday,
+				startDate=startDate, endDate=endDate, startTime=x.startTime, endTime=x.endTime)
+		courses.setdefault(courseKey(course), course)
+
+	expanded = set(x for x, in db.session.query(CourseOccurrence.courseId).distinct())
+	occurrences = []
+	removed = []
+	for course in Course.query.options(db.joinedload(Course.teacher)):
+		key = courseKey(course)
+		if key not in courses:
+			removed.append(course)
+			changes.append('- {}'.format(course))
+		else:
+			del courses[key]
+			if course.id not in expanded:
+				occurrences += occurrenceRows(course)
+	if removed:
+		removedIds = [x.id for x in removed]
+		CourseOccurrence.query.filter(CourseOccurrence.courseId.in_(removedIds)).delete(
+				synchronize_session=False)
+		Course.query.filter(Course.id.in_(removedIds)).delete(synchronize_session=False)
+		#新的课程可能重用这些id
+		for course in removed:
+			db.session.expunge(course)
+
+	newCourses = list(courses.values())
+	db.session.add_all(newCourses)
+	db.session.flush()
+	for course in newCourses:
+		changes.append('+ {}'.format(course))
+		occurrences += occurrenceRows(course)
+	if occurrences:
+		db.session.execute(CourseOccurrence.__table__.insert(), occurrences)
+
+	if removed or occurrences:
+		bumpStamp('occupancy')
+	return changes
+
+
+def refreshShows():
+	"""
+	按performers.txt更新演出：为新出现的演员添加演出，删除文件中已没有的演员的演出。
+	不提交，返回变化的描述。
+	"""
+	names = importer.readPerformers('performers.txt')
+	userIds, newUsers = getCreateUsers(names)
+	changes = ['+ 用户 {}'.format(x) for x in newUsers]
+
+	performerIds = set(userIds[x] for x in names)
+	existing = set()
+	removedIds = []
+	for showId, performerId, name in (db.session.query(Show.id, Show.performerId, User.name)
+			.join(User, Show.performerId==User.id)):
+		if performerId in performerIds and performerId not in existing:
+			existing.add(performerId)
+		else:
+			removedIds.append(showId)
+			changes.append('- 演出 {}'.format(name))
+	if removedIds:
+		Show.query.filter(Show.id.in_(removedIds)).delete(synchronize_session=False)
+
+	newShows = [dict(performerId=userIds[x]) for x in names if userIds[x] not in existing]
+	changes += ['+ 演出 {}'.format(x) for x in names if userIds[x] not in existing]
+	if newShows:
+		db.session.execute(Show.__table__.insert(), newShows)
+	return changes
+
+
+def applyChanges(changes, dryRun):
+	'打印变化，试运行时回滚，否则确认后提交'
+	for x in changes:
+		print(x)
+	if not changes:
+		print('no changes')
+	if dryRun or not changes:
+		db.session.rollback()
+	elif input("Apply these changes? ")=='yes':
 		db.session.commit()
-	print('got', name, user)
-	return user
+		print('done')
+	else:
+		db.session.rollback()
+		print('aborted')
 
 
 if __name__=='__main__':
-	if len(sys.argv)==2 and sys.argv[1]=='init':
+	if len(sys.argv) in (2, 3) and sys.argv[1]=='init':
 		if input("All data will be deleted. Are you sure? ")=='yes':
-			initDb()
-			print('done')
-		else:
-			print('aborted')
-	elif len(sys.argv)==2 and sys.argv[1]=='refreshcourses':
-		if input("Old courses will be deleted. Are you sure? ")=='yes':
-			refreshCourses()
+			for x in initDb(*sys.argv[2:]):
+				print(x)
 			print('done')
 		else:
 			print('aborted')
+	elif len(sys.argv) in (3, 4) and sys.argv[1]=='checkoccupancy':
+		#checkoccupancy http://host/papuwx/occupancy [请求次数]，请求次数应足以覆盖所有worker
+		results = checkOccupancy(sys.argv[2], *map(int, sys.argv[3:]))
+		for pid, stamp, fingerprint, result in results:
+			print('pid {} stamp {} {} {}'.format(pid, stamp, fingerprint[:12], result))
+		sys.exit(0 if all(x[3]=='ok' for x in results) else 1)
+	elif len(sys.argv)==2 and sys.argv[1]=='checkplans':
+		ok = True
+		for name, plan, fullScan in checkPlans():
+			print('{}{}'.format(name, ' FULL SCAN' if fullScan else ''))
+			for x in plan:
+				print('\t'+x)
+			ok = ok and not fullScan
+		sys.exit(0 if ok else 1)
+	elif len(sys.argv)==2 and sys.argv[1]=='maintain':
+		print(formatMaintenance(maintain()))
+	elif len(sys.argv)==3 and sys.argv[1]=='metrics':
+		print(fetchPage(sys.argv[2]), end='')
+	elif len(sys.argv) in (2, 3) and sys.argv[1] in ('refreshcourses', 'refreshshows'):
+		#加上dryrun只显示变化，不写入
+		refresh = refreshCourses if sys.argv[1]=='refreshcourses' else refreshShows
+		applyChanges(refresh(), sys.argv[2:]==['dryrun'])
 	else:
-		Manager(app).run()
+		manager = Manager(app)
+		manager.add_command('db', MigrateCommand)
+		manager.run()
 		#app.run(debug=True, host='::', port=80)
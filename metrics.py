@@ -0,0 +1,70 @@
+# vim: set noet ts=4 sw=4 fileencoding=utf-8:
+
+'''
+进程内的延迟直方图。每个uwsgi worker各自计数，不加锁：
+GIL下偶尔丢失一次并发的计数可以接受，换来的是每次记录只有一次二分查找和两次加法。
+'''
+
+import os
+import time
+import bisect
+import functools
+
+#秒，最后一个桶为+Inf
+bounds = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+	__slots__ = ('counts', 'sum')
+
+	def __init__(self):
+		self.counts = [0]*(len(bounds)+1)
+		self.sum = 0.0
+
+	def observe(self, seconds):
+		self.counts[bisect.bisect_left(bounds, seconds)] += 1
+		self.sum += seconds
+
+
+class Metrics:
+	def __init__(self, prefix):
+		self.prefix = prefix
+		self.histograms = {} # (metric, name) -> Histogram
+
+	def observe(self, metric, name, seconds):
+		histogram = self.histograms.get((metric, name))
+		if histogram is None:
+			histogram = self.histograms.setdefault((metric, name), Histogram())
+		histogram.observe(seconds)
+
+	def timed(self, metric, name=None):
+		'装饰器，记录每次调用的耗时，name默认为函数名'
+		def decorate(func):
+			label = name or func.__name__
+			@functools.wraps(func)
+			def newFunc(*args, **kwargs):
+				start = time.perf_counter()
+				try:
+					return func(*args, **kwargs)
+				finally:
+					self.observe(metric, label, time.perf_counter()-start)
+			return newFunc
+		return decorate
+
+	def format(self):
+		'Prometheus的文本格式，带上pid以区分各个worker'
+		lines = []
+		pid = os.getpid()
+		for metric in sorted(set(x[0] for x in self.histograms)):
+			fullName = '{}_{}_seconds'.format(self.prefix, metric)
+			lines.append('# TYPE {} histogram'.format(fullName))
+			for (m, name), histogram in sorted(self.histograms.items()):
+				if m != metric: continue
+				labels = 'name="{}",pid="{}"'.format(name, pid)
+				total = 0
+				for bound, count in zip(bounds + ('+Inf',), histogram.counts):
+					total += count
+					lines.append('{}_bucket{{{},le="{}"}} {}'.format(fullName, labels, bound, total))
+				lines.append('{}_sum{{{}}} {:.6f}'.format(fullName, labels, histogram.sum))
+				lines.append('{}_count{{{}}} {}'.format(fullName, labels, total))
+		return '\n'.join(lines) + '\n'
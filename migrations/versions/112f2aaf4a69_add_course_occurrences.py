@@ -0,0 +1,75 @@
+"""add course occurrences
+
+Revision ID: 112f2aaf4a69
+Revises: 0676fb260aa4
+Create Date: 2026-10-18 17:35:12.904318
+
+"""
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '112f2aaf4a69'
+down_revision = '0676fb260aa4'
+branch_labels = None
+depends_on = None
+
+
+course = sa.table('course',
+    sa.column('id', sa.Integer()),
+    sa.column('roomId', sa.Integer()),
+    sa.column('weekday', sa.Integer()),
+    sa.column('startDate', sa.Date()),
+    sa.column('endDate', sa.Date()),
+    sa.column('startTime', sa.Time()),
+    sa.column('endTime', sa.Time()),
+)
+courseOccurrence = sa.table('course_occurrence',
+    sa.column('courseId', sa.Integer()),
+    sa.column('roomId', sa.Integer()),
+    sa.column('start', sa.DateTime()),
+    sa.column('end', sa.DateTime()),
+)
+
+
+def occurrenceRows(x):
+    '与main.occurrenceRows相同：把每周的课程规则展开成startDate~endDate间的每一次课'
+    rows = []
+    date = x.startDate + datetime.timedelta(days=(x.weekday-x.startDate.weekday())%7)
+    while date <= x.endDate:
+        rows.append(dict(courseId=x.id, roomId=x.roomId,
+            start=datetime.datetime.combine(date, x.startTime),
+            end=datetime.datetime.combine(date, x.endTime)))
+        date += datetime.timedelta(days=7)
+    return rows
+
+
+def upgrade():
+    op.create_table('course_occurrence',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('courseId', sa.Integer(), nullable=False),
+        sa.Column('roomId', sa.Integer(), nullable=False),
+        sa.Column('start', sa.DateTime(), nullable=False),
+        sa.Column('end', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['courseId'], ['course.id'], ),
+        sa.ForeignKeyConstraint(['roomId'], ['room.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_course_occurrence_courseId'), 'course_occurrence', ['courseId'], unique=False)
+    op.create_index(op.f('ix_course_occurrence_start'), 'course_occurrence', ['start'], unique=False)
+
+    # 展开已有的课程，使预约的冲突检查和查询不必等到手动运行refreshcourses
+    rows = []
+    for x in op.get_bind().execute(course.select()):
+        rows += occurrenceRows(x)
+    if rows:
+        op.bulk_insert(courseOccurrence, rows)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_course_occurrence_start'), table_name='course_occurrence')
+    op.drop_index(op.f('ix_course_occurrence_courseId'), table_name='course_occurrence')
+    op.drop_table('course_occurrence')
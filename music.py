@@ -1,23 +1,58 @@
 # vim: set noet ts=4 sw=4 fileencoding=utf-8:
 
+import os
+import array
 import random
 import sqlite3
+import threading
 
-conn = sqlite3.connect('music.db')
+
+class MusicCatalog:
+	"""
+	随机歌曲。所有歌曲的id在第一次使用时载入为一个紧凑的数组，数据库文件变化后重新载入，
+	因此抽取时不需要COUNT(*)，id有空缺时每首歌被抽到的概率也相同。
+	连接按进程和线程分别建立：uwsgi在导入后fork，各个worker不能共用master里的连接。
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.local = threading.local()
+		self.lock = threading.Lock()
+		self.ids = array.array('q')
+		self.version = None
+
+	def connection(self):
+		if getattr(self.local, 'pid', None) != os.getpid():
+			self.local.pid = os.getpid()
+			self.local.conn = sqlite3.connect(self.path)
+		return self.local.conn
+
+	def refresh(self):
+		'数据库文件的修改时间或大小变化时重新载入id'
+		stat = os.stat(self.path)
+		version = (stat.st_mtime_ns, stat.st_size)
+		if version == self.version: return
+		with self.lock:
+			if version == self.version: return
+			#只载入有专辑的歌曲，与sample中的JOIN一致，抽到的id都能取出
+			self.ids = array.array('q', (x for x, in self.connection().execute(
+				'SELECT song.id FROM song JOIN album ON song.albumId=album.id ORDER BY song.id')))
+			self.version = version
+
+	def sample(self, k):
+		'不重复的k首歌（不足k首时为全部），一次查询取出标题、链接和专辑图片'
+		self.refresh()
+		ids = random.sample(self.ids, min(k, len(self.ids)))
+		rows = self.connection().execute('SELECT song.id, song.title, song.url, album.image '
+				'FROM song JOIN album ON song.albumId=album.id '
+				'WHERE song.id IN ({})'.format(','.join('?'*len(ids))), ids).fetchall()
+		songs = {theId: dict(title=title, url=url, image=image) for theId, title, url, image in rows}
+		return [songs[x] for x in ids if x in songs]
+
+
+catalog = MusicCatalog('music.db')
 
 def randomMusic():
-	curs = conn.cursor()
-	curs.execute('SELECT COUNT(*) FROM song')
-	count = curs.fetchone()[0]
-
-	num = random.randrange(count)
-	curs = conn.cursor()
-	curs.execute('SELECT song.title, song.url, album.image '
-			'FROM song JOIN album ON song.albumId=album.id '
-			'WHERE song.id>=? ORDER BY song.id LIMIT 1', (num,))
-
-	title, url, image = curs.fetchone()
-	return dict(title=title, url=url, image=image)
+	return catalog.sample(1)[0]
 
 
 if __name__=='__main__':
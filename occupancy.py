@@ -0,0 +1,127 @@
+# vim: set noet ts=4 sw=4 fileencoding=utf-8:
+
+import heapq
+import bisect
+import hashlib
+import threading
+
+
+def overlaps(start0, end0, start, end):
+	'与overlayedReservation相同的判断：( [ ) 或 [ ( ]'
+	return (start0<start and end0>start) or (start<=start0 and start0<end)
+
+
+def freeIntervals(busy, start, end):
+	'busy为按开始时间排序的(开始, 结束, ...)，一次扫描得到start~end中不被占用的区间'
+	result = []
+	cursor = start
+	for x in busy:
+		if x[0] >= end: break
+		if x[0] > cursor:
+			result.append((cursor, x[0]))
+		cursor = max(cursor, x[1])
+	if cursor < end:
+		result.append((cursor, end))
+	return result
+
+
+class OccupancyIndex:
+	"""
+	进程内的琴房占用索引，只包含since及之后的日期。
+	预约按日期、房间分组，组内按(开始, 结束)排序；课程按日期保存每一次课。
+	stamp为建立索引时数据库中的版本号，用于发现其他进程的修改。
+	rendered按日期缓存调用者由当天的占用生成的内容，当天的预约或课程变化时丢弃。
+	"""
+	def __init__(self, since, stamp):
+		self.since = since
+		self.stamp = stamp
+		self.reservations = {} # date -> room -> [(start, end, id, repr)]
+		self.reservationKeys = {} # id -> (date, room)
+		self.courses = {} # date -> [(start, end, room, repr)]
+		self.renderCache = {} # date -> render(date)的结果
+		self.changes = 0
+		self.lock = threading.Lock()
+
+	def changed(self, date):
+		with self.lock:
+			self.changes += 1
+			self.renderCache.pop(date, None)
+
+	def addReservation(self, theId, room, start, end, repr):
+		if start.date() < self.since: return
+		rooms = self.reservations.setdefault(start.date(), {})
+		bisect.insort(rooms.setdefault(room, []), (start, end, theId, repr))
+		self.reservationKeys[theId] = (start.date(), room)
+		self.changed(start.date())
+
+	def removeReservation(self, theId):
+		key = self.reservationKeys.pop(theId, None)
+		if key is None: return
+		date, room = key
+		day = self.reservations[date][room]
+		day[:] = [x for x in day if x[2]!=theId]
+		self.changed(date)
+
+	def addCourse(self, room, start, end, repr):
+		if start.date() < self.since: return
+		bisect.insort(self.courses.setdefault(start.date(), []), (start, end, room, repr))
+		self.changed(start.date())
+
+	def overlayedReservation(self, room, start, end):
+		'与start~end重叠的预约，start和end须在同一天'
+		result = []
+		for x in self.reservations.get(start.date(), {}).get(room, []):
+			if x[0] >= end: break
+			if overlaps(x[0], x[1], start, end):
+				result.append(x)
+		return result
+
+	def overlayedCourse(self, start, end):
+		'与start~end重叠的课程（任意房间），start和end须在同一天'
+		result = []
+		for x in self.courses.get(start.date(), []):
+			if x[0] >= end: break
+			if overlaps(x[0], x[1], start, end):
+				result.append(x)
+		return result
+
+	def freeIntervals(self, room, start, end, withCourses=False):
+		'room在start~end（同一天）中的空闲区间。withCourses时任意房间的课程也算占用，与overlayedCourse相同'
+		busy = self.reservations.get(start.date(), {}).get(room, [])
+		if withCourses:
+			busy = heapq.merge(busy, self.courses.get(start.date(), []), key=lambda x: x[0])
+		return freeIntervals(busy, start, end)
+
+	def occupations(self, date):
+		'当天的(预约, 课程)，供formatReservation使用'
+		reservations = [dict(room=room, start=x[0].time(), end=x[1].time(), repr=x[3])
+				for room, day in self.reservations.get(date, {}).items()
+				for x in day]
+		courses = [dict(room=x[2], start=x[0].time(), end=x[1].time(), repr=x[3])
+				for x in self.courses.get(date, [])]
+		return (reservations, courses)
+
+	def rendered(self, date, render):
+		'render(date)的结果，按日期缓存。生成期间另一个线程修改了索引时不缓存，以免存下过时的内容'
+		try:
+			return self.renderCache[date]
+		except KeyError:
+			pass
+		changes = self.changes
+		result = render(date)
+		with self.lock:
+			if changes == self.changes:
+				self.renderCache[date] = result
+		return result
+
+	def fingerprint(self):
+		'用于和数据库或其他进程的索引比对'
+		h = hashlib.sha1()
+		for date in sorted(self.reservations):
+			for room in sorted(self.reservations[date]):
+				for x in self.reservations[date][room]:
+					h.update(repr((date, room, x)).encode('utf8'))
+		for date in sorted(self.courses):
+			for x in self.courses[date]:
+				h.update(repr((date, x)).encode('utf8'))
+		return h.hexdigest()
@@ -3,27 +3,53 @@
 
 import re
 import datetime
+import functools
 
 from processor import pattern
-from utils import currentDate, toDatetime
+from utils import currentTime, currentDate, toDatetime, frozenClock
 
 
-def prefix(prefixPat):
+#所有命令的入口，在本模块末尾编译
+commands = []
+
+
+def prefix(prefixPat, check=None):
+	"""
+	解析结果按(去掉前缀的输入, 当天日期)缓存，解析过程中看到的当前时间固定为当天零点。
+	依赖当前时刻的检查不能放进解析过程，应作为check(result)传入，每次都会执行。
+	"""
 	def decorate(entry):
+		@functools.lru_cache(maxsize=256)
+		def cachedEntry(inputStr, today):
+			with frozenClock(toDatetime(today)):
+				return entry(inputStr)
+
 		def newEntry(inputStr):
 			prefixMatch = re.match(prefixPat, inputStr)
 			if prefixMatch is None: return
 
 			start = prefixMatch.end()
-			result = entry(inputStr[start:].strip())
+			result = cachedEntry(inputStr[start:].strip(), currentDate())
 			if result is None:
 				raise MyValueError(inputStr[start:])
+			if check is not None:
+				check(result)
 			return result
+		newEntry.prefix = prefixPat
+		newEntry.cacheInfo = cachedEntry.cache_info
+		newEntry.cacheClear = cachedEntry.cache_clear
+		newEntry.compile = entry.compile
+		commands.append(newEntry)
 		return newEntry
 	return decorate
 
 
-@prefix(r'预约')
+def notPast(result):
+	if result[0] < currentTime():
+		raise ValueError('不能预约过去的时间')
+
+
+@prefix(r'预约', check=notPast)
 @pattern(r'^(?:#(date:date)的?)?\s*\
 		   #(time:time1)\s*\
 		   #(to)\s*\
@@ -31,7 +57,15 @@ def prefix(prefixPat):
 		   (?:[的\s]#(roomName:roomName))?$')
 def reservation(result, date, time1, time2, roomName):
 	'返回(开始datetime, 结束datetime)'
-	date = date or datetime.date.today()
+	date = date or currentDate()
+	time1, time2 = timeRange(result, time1, time2)
+	return (datetime.datetime.combine(date, time1),
+			datetime.datetime.combine(date, time2),
+			roomName)
+
+
+def timeRange(result, time1, time2):
+	'返回(开始time, 结束time)'
 	if not time1['time']<time2['time']:
 		# 如果是“下午三点到五点”（此时time1.hour==15, time2.hour==5）
 		# 将其调整为15点到17点
@@ -42,12 +76,28 @@ def reservation(result, date, time1, time2, roomName):
 		if not (time1['time']<time2['time'] and
 				time1['section'][0]<=time2['time']<=time1['section'][1]):
 			raise MyValueError(result)
-	result = (datetime.datetime.combine(date, time1['time']),
-			datetime.datetime.combine(date, time2['time']),
-			roomName)
-	if result[0] < datetime.datetime.now():
-		raise ValueError('不能预约过去的时间')
-	return result
+	return time1['time'], time2['time']
+
+
+@prefix(r'每(?=星期|礼拜|周)')
+@pattern(r'^#(weekDate:weekDate)的?\s*\
+		   #(time:time1)\s*\
+		   #(to)\s*\
+		   #(time:time2)\s*\
+		   (?:[的\s]#(roomName:roomName)\s*)?\
+		   预约#(number:weeks)(?:个?星期|个?礼拜|周|次)$')
+def recurringReservation(result, weekDate, time1, time2, roomName, weeks):
+	"""
+	例：每周三七点到九点 预约四周，每周六下午三点到五点 B252 预约两次
+	返回(第一次的开始datetime, 第一次的结束datetime, 次数, 房间名)。
+	第一次为今天或之后最近的那一天，如果那时已经过去，由处理函数顺延一周
+	"""
+	time1, time2 = timeRange(result, time1, time2)
+	if not 1<=weeks<=52:
+		raise MyValueError(result)
+	return (datetime.datetime.combine(weekDate, time1),
+			datetime.datetime.combine(weekDate, time2),
+			weeks, roomName)
 
 
 @prefix(r'取消预约|取消')
@@ -57,7 +107,7 @@ def reservation(result, date, time1, time2, roomName):
 			(?:[的\s]#(roomName:roomName))?$')
 def cancellation(result, date, time, roomName):
 	'即便提供了结束时间，也将其忽略'
-	date = date or datetime.date.today()
+	date = date or currentDate()
 	return (datetime.datetime.combine(date, time['time']), roomName)
 
 
@@ -71,6 +121,21 @@ def query(result, date, week):
 	return (toDatetime(max(currentDate(), week[0])), toDatetime(week[1]))
 
 
+@prefix(r'空闲')
+@pattern(r'^(?:#(date:date)|#(week:week))?的?\s*#(freeSection:section)?\s*#(duration:duration)?$')
+def freeSlots(result, date, week, section, duration):
+	"""
+	例：空闲，空闲明天下午，空闲周六 两小时，空闲下周 一个半小时
+	返回(开始日期, 结束日期（不含）, 时段或None, 最短时长)，时长默认为半小时
+	"""
+	if week is not None:
+		startDate, endDate = max(currentDate(), week[0]), week[1]
+	else:
+		startDate = date or currentDate()
+		endDate = startDate + datetime.timedelta(days=1)
+	return (startDate, endDate, section, duration or datetime.timedelta(minutes=30))
+
+
 @prefix(r'查询我的预约')
 @pattern(r'^$')
 def queryMyself(result):
@@ -141,6 +206,16 @@ def absDate(result, year, month, day):
 		raise MyValueError(result)
 
 
+@pattern(r'#(number:hours)个?#(halfHour:half)?(?:小时|钟头)|#(halfHour:halfOnly)个?(?:小时|钟头)|#(number:minutes)分钟?')
+def duration(result, hours, half, halfOnly, minutes):
+	'例：1小时，两个小时，一个半小时，半小时，90分钟'
+	if minutes is None:
+		minutes = halfOnly if halfOnly is not None else hours*60 + (half or 0)
+	if not 0<minutes<=24*60:
+		raise MyValueError(result)
+	return datetime.timedelta(minutes=minutes)
+
+
 @pattern(r'#(weekCount:weekCount)(?:星期|礼拜|周)')
 def week(result, weekCount):
 	date = currentDate()
@@ -232,6 +307,19 @@ def sectionEvening(result):
 	return (datetime.time(12,0,0), datetime.time(23,59,59))
 
 
+@pattern(r'早上?|上午|下午|傍晚|晚上?')
+def freeSection(result):
+	"""
+	空闲时段的查找范围。section的范围很宽，只用来判断几点是上午还是下午，
+	这里则把一天分开：上午到12点，下午12点到18点，晚上18点之后（都再与琴房开放时间取交集）
+	"""
+	if result in ('早', '早上', '上午'):
+		return (datetime.time(0,0,0), datetime.time(12,0,0))
+	if result == '下午':
+		return (datetime.time(12,0,0), datetime.time(18,0,0))
+	return (datetime.time(18,0,0), datetime.time(23,59,59))
+
+
 @pattern(r'#(number:number)[点时:：]')
 def hour(result, number):
 	if not 0<=number<24:
@@ -298,6 +386,11 @@ class MyValueError(ValueError):
 		ValueError.__init__(self, '不能识别"%s"'%msg)
 
 
+#所有模式都已定义。命令的正则在导入时编译，uwsgi的master导入后fork，各个worker不必各自编译
+for command in commands:
+	command.compile()
+
+
 if __name__=='__main__':
 	import processor
 	import re
@@ -1,6 +1,7 @@
 # vim: set noet ts=4 sw=4 fileencoding=utf-8:
 
 import re
+import collections
 
 dependsRev = {}
 
@@ -22,6 +23,8 @@ class ExtPattern:
 		self.patternList = patternList
 		self.func = func
 		self.depends = depends
+		self.regex = None
+		self.groups = None
 		ExtPattern.collection[func.__name__] = self
 
 	def calcPattern(self, myName=None):
@@ -31,18 +34,37 @@ class ExtPattern:
 		pattern = ''.join(patternList0)
 		return r'(?P<%s>%s)'%(myName,pattern) if myName else pattern
 
-	def wrap(self, matchObj, prefix=None):
-		matchStr = matchObj.group(prefix) if prefix else matchObj.group()
-		if matchStr is None: return
-
-		prefix = prefix+'_' if prefix else ExtPattern.rootName
-		args = {}
+	def calcGroups(self, groupIndex, myName=None):
+		'把命名分组换算成分组序号，得到与patternList同构的树：[(name, child, index, childGroups)]'
+		prefix = myName+'_' if myName else ExtPattern.rootName
+		groups = []
 		for piece in self.patternList:
 			if isinstance(piece, tuple):
 				name, child = piece
-				arg = child.wrap(matchObj, prefix+escape(name))
-				if not isinstance(name, int):
-					args[name] = arg
+				childName = prefix+escape(name)
+				groups.append((name, child, groupIndex[childName],
+						child.calcGroups(groupIndex, childName)))
+		return groups
+
+	def compile(self):
+		"""
+		在首次匹配时编译：大多数模式只作为其他模式的一部分出现，从不单独匹配。
+		命令的模式由patterns在导入时编译，fork出的各个worker直接继承。
+		先算出两者再赋值，另一个线程看到regex不为None时groups一定已经可用
+		"""
+		regex = re.compile(self.calcPattern())
+		self.groups = self.calcGroups(regex.groupindex)
+		self.regex = regex
+
+	def wrap(self, matchObj, groups=None, index=0):
+		matchStr = matchObj.group(index)
+		if matchStr is None: return
+
+		args = {}
+		for name, child, childIndex, childGroups in (self.groups if groups is None else groups):
+			arg = child.wrap(matchObj, childGroups, childIndex)
+			if not isinstance(name, int):
+				args[name] = arg
 		return self.func(matchStr, **args)
 
 	def resolvable(self):
@@ -99,15 +121,69 @@ def pattern(extPattern):
 		me = ExtPattern(patternList, func, depends)
 		me.resolve()
 
-		def entry(inputStr):
+		def compile():
 			if not me.resolvable():
 				raise RuntimeError('%s not yet resolvable, depends on %s' %
 						(me.func.__name__, ', '.join(me.depends)))
+			if me.regex is None:
+				me.compile()
 
-			matchObj = re.match(me.calcPattern(), inputStr)
+		def entry(inputStr):
+			compile()
+			matchObj = me.regex.match(inputStr)
 			if matchObj is None: return
 			return me.wrap(matchObj)
 
+		entry.compile = compile
 		return entry
 	return decorate
 
+
+
+class Dispatcher:
+	"""
+	按前缀把输入分派给处理函数。
+	所有前缀按注册顺序合并成一个正则，一次匹配即可找到第一个前缀相符的处理函数；
+	处理函数返回None时，继续尝试之后前缀相符的处理函数，与逐个尝试的结果一致。
+	prefix为None的处理函数对任何输入都会被尝试。
+	"""
+	def __init__(self):
+		self.handlers = []
+		self.regex = None
+		self.hits = collections.Counter()
+
+	def register(self, func, prefix=None):
+		self.handlers.append((func, re.compile(prefix or '')))
+		self.regex = None
+		return func
+
+	def compile(self):
+		'把所有前缀合并成一个正则，注册新的处理函数后在下次匹配时重新编译'
+		self.regex = re.compile('|'.join('(?P<h%d>%s)' % (i, prefix.pattern)
+				for i, (func, prefix) in enumerate(self.handlers)))
+
+	def candidates(self, inputStr):
+		'前缀相符的处理函数，按尝试的顺序'
+		if self.regex is None:
+			self.compile()
+
+		key = inputStr.lstrip()
+		matchObj = self.regex.match(key)
+		if matchObj is None: return
+		first = int(matchObj.lastgroup[1:])
+		for func, prefix in self.handlers[first:]:
+			if prefix.match(key) is not None:
+				yield func
+
+	def dispatch(self, inputStr):
+		return self.dispatchWithName(inputStr)[1]
+
+	def dispatchWithName(self, inputStr):
+		'返回(处理函数名, 结果)，没有处理函数接受时为(None, None)'
+		for func in self.candidates(inputStr):
+			result = func(inputStr)
+			if result is not None:
+				self.hits[func.__name__] += 1
+				return func.__name__, result
+		self.hits[None] += 1
+		return None, None
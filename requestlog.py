@@ -0,0 +1,81 @@
+# vim: set noet ts=4 sw=4 fileencoding=utf-8:
+
+'''
+请求日志。每个请求一行JSON，请求线程只把记录放进队列，由后台线程写入文件并按大小轮转。
+
+uwsgi在导入后fork，而线程不会随fork复制，所以后台线程在每个进程第一次写日志时才启动。
+多个worker写同一个文件时轮转会互相干扰，路径中可以用{worker}区分。
+'''
+
+import os
+import json
+import queue
+import atexit
+import random
+import hashlib
+import logging
+import logging.handlers
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+	'队列满时丢弃记录而不是阻塞请求'
+	def __init__(self, queue):
+		logging.handlers.QueueHandler.__init__(self, queue)
+		self.dropped = 0
+
+	def enqueue(self, record):
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+	def format(self, record):
+		return json.dumps(record.fields, ensure_ascii=False, sort_keys=True)
+
+
+def workerId():
+	try:
+		import uwsgi
+		return uwsgi.worker_id()
+	except ImportError:
+		return 0
+
+
+class RequestLog:
+	"""
+	sampleRate为成功的请求被记录的比例，出错的请求总是记录。
+	openId只记录加盐后的散列，足以把同一个用户的请求联系起来。
+	"""
+	def __init__(self, path, maxBytes, backupCount, sampleRate=1.0, salt='', queueSize=10000):
+		self.path = path
+		self.maxBytes = maxBytes
+		self.backupCount = backupCount
+		self.sampleRate = sampleRate
+		self.salt = salt
+		self.queueSize = queueSize
+		self.pid = None
+
+	def start(self):
+		self.pid = os.getpid()
+		fileHandler = logging.handlers.RotatingFileHandler(self.path.format(worker=workerId()),
+				maxBytes=self.maxBytes, backupCount=self.backupCount, encoding='utf8')
+		self.handler = DroppingQueueHandler(queue.Queue(self.queueSize))
+		self.handler.setFormatter(JsonFormatter())
+		self.listener = logging.handlers.QueueListener(self.handler.queue, fileHandler)
+		self.listener.start()
+		atexit.register(self.listener.stop)
+
+	def hashOpenId(self, openId):
+		if openId is None: return None
+		return hashlib.sha1((self.salt+openId).encode('utf8')).hexdigest()[:16]
+
+	def write(self, fields):
+		if fields.get('outcome') != 'error' and random.random() >= self.sampleRate:
+			return
+		if self.pid != os.getpid():
+			self.start()
+		record = logging.LogRecord('request', logging.INFO, __file__, 0, '', None, None)
+		record.fields = fields
+		self.handler.handle(record)
@@ -0,0 +1,87 @@
+# vim: set noet ts=4 sw=4 fileencoding=utf-8:
+
+'''
+主动发送消息（客服消息）。用于被动回复来不及时，处理完毕后再把结果发给用户。
+
+每种发送器实现send(openId, replyDict)，replyDict与被动回复的格式相同。
+'''
+
+import json
+import time
+import threading
+import urllib.parse
+import urllib.request
+
+
+class SendError(Exception):
+	pass
+
+
+def customMessage(openId, replyDict):
+	'把被动回复的字典转换为客服消息接口的格式'
+	msgType = replyDict['MsgType']
+	message = dict(touser=openId, msgtype=msgType)
+	if msgType == 'text':
+		message['text'] = dict(content=replyDict['Content'])
+	elif msgType == 'news':
+		message['news'] = dict(articles=[dict(title=x['Title'], description=x.get('Description', ''),
+				url=x['Url'], picurl=x['PicUrl']) for name, x in replyDict['Articles']])
+	elif msgType == 'music':
+		x = replyDict['Music']
+		message['music'] = dict(title=x['Title'], description=x['Description'],
+				musicurl=x['MusicUrl'], hqmusicurl=x['HQMusicUrl'],
+				thumb_media_id=x.get('ThumbMediaId', ''))
+	else:
+		raise SendError('不支持的消息类型 {}'.format(msgType))
+	return message
+
+
+class StubSender:
+	'不真正发送，只保存在sent中，供测试和本地运行'
+	def __init__(self):
+		self.sent = []
+		self.lock = threading.Lock()
+
+	def send(self, openId, replyDict):
+		message = customMessage(openId, replyDict)
+		with self.lock:
+			self.sent.append(message)
+		print('stub send', json.dumps(message, ensure_ascii=False))
+
+
+class WeChatSender:
+	'调用微信的客服消息接口。access_token由本进程获取并缓存，到期前一分钟刷新'
+	tokenUrl = 'https://api.weixin.qq.com/cgi-bin/token'
+	sendUrl = 'https://api.weixin.qq.com/cgi-bin/message/custom/send'
+
+	def __init__(self, appId, appSecret, timeout=10):
+		self.appId = appId
+		self.appSecret = appSecret
+		self.timeout = timeout
+		self.token = None
+		self.expires = 0
+		self.lock = threading.Lock()
+
+	def request(self, url, params, data=None):
+		url = '{}?{}'.format(url, urllib.parse.urlencode(params))
+		if data is not None:
+			data = json.dumps(data, ensure_ascii=False).encode('utf8')
+		with urllib.request.urlopen(urllib.request.Request(url, data,
+				{'Content-Type': 'application/json'}), timeout=self.timeout) as f:
+			result = json.loads(f.read().decode('utf8'))
+		if result.get('errcode'):
+			raise SendError('{errcode}: {errmsg}'.format(**result))
+		return result
+
+	def accessToken(self):
+		with self.lock:
+			if self.token is None or time.time() >= self.expires:
+				result = self.request(self.tokenUrl, dict(grant_type='client_credential',
+						appid=self.appId, secret=self.appSecret))
+				self.token = result['access_token']
+				self.expires = time.time() + result['expires_in'] - 60
+			return self.token
+
+	def send(self, openId, replyDict):
+		self.request(self.sendUrl, dict(access_token=self.accessToken()),
+				customMessage(openId, replyDict))
@@ -1,11 +1,69 @@
 #!/usr/bin/python3
 # vim: set noet ts=4 sw=4 fileencoding=utf-8:
 
+import time
 import datetime
+import threading
+import contextlib
+import collections
+
+#每个线程各自的冻结时刻：fast-ack模式下处理函数在线程池中运行，冻结不能影响其他线程
+local = threading.local()
+
+
+def currentTime():
+	'当前时间。本线程在frozenClock中时返回冻结的时刻，用于测试和解析缓存'
+	now = getattr(local, 'frozenNow', None)
+	if now is not None:
+		return now
+	return datetime.datetime.now()
+
 
 def currentDate():
-	return datetime.datetime.now().date()
+	return currentTime().date()
+
+
+@contextlib.contextmanager
+def frozenClock(now):
+	'只对当前线程有效'
+	old, local.frozenNow = getattr(local, 'frozenNow', None), now
+	try: yield
+	finally: local.frozenNow = old
 
 
 def toDatetime(date):
 	return datetime.datetime.combine(date, datetime.time())
+
+
+class TTLCache:
+	'容量有限、条目会过期的LRU缓存。同一进程的多个线程共用，各操作加锁'
+	def __init__(self, maxsize, ttl):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.data = collections.OrderedDict() # key -> (过期时刻, value)
+		self.hits = self.misses = 0
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		with self.lock:
+			item = self.data.get(key)
+			if item is not None and item[0] < time.monotonic():
+				del self.data[key]
+				item = None
+			if item is None:
+				self.misses += 1
+				return None
+			self.data.move_to_end(key)
+			self.hits += 1
+			return item[1]
+
+	def set(self, key, value):
+		with self.lock:
+			self.data[key] = (time.monotonic()+self.ttl, value)
+			self.data.move_to_end(key)
+			while len(self.data) > self.maxsize:
+				self.data.popitem(last=False)
+
+	def pop(self, key):
+		with self.lock:
+			self.data.pop(key, None)
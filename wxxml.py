@@ -0,0 +1,74 @@
+# vim: set noet ts=4 sw=4 fileencoding=utf-8:
+
+'''
+微信消息的XML。收到的消息用同一个加固过的解析器解析为{标签: 文字}，
+被动回复按消息类型套用预先写好的模板，不再逐个构造Element。
+'''
+
+import re
+import threading
+from xml.sax.saxutils import escape
+from lxml import etree
+
+#XML 1.0不允许的字符，lxml遇到它们会抛出异常，这里直接去掉
+invalidChars = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+def cdata(text):
+	'任何文字都可以放进CDATA：去掉不允许的字符，并把]]>拆到两段CDATA中'
+	text = invalidChars.sub('', str(text))
+	return '<![CDATA[{}]]>'.format(text.replace(']]>', ']]]]><![CDATA[>'))
+
+
+header = ('<xml><ToUserName>{}</ToUserName><FromUserName>{}</FromUserName>'
+		'<CreateTime>{}</CreateTime><MsgType>{}</MsgType>')
+templates = dict(
+	text = header + '<Content>{Content}</Content></xml>',
+	news = header + '<ArticleCount>{ArticleCount}</ArticleCount><Articles>{Articles}</Articles></xml>',
+	music = header + ('<Music><Title>{Title}</Title><Description>{Description}</Description>'
+		'<MusicUrl>{MusicUrl}</MusicUrl><HQMusicUrl>{HQMusicUrl}</HQMusicUrl></Music></xml>'),
+)
+articleTemplate = ('<item><Title>{Title}</Title><Description>{Description}</Description>'
+		'<PicUrl>{PicUrl}</PicUrl><Url>{Url}</Url></item>')
+
+
+def formatReply(ToUserName, FromUserName, CreateTime, replyDict):
+	'replyDict为处理函数返回的字典，MsgType为text、news或music。返回utf8编码的bytes'
+	msgType = replyDict['MsgType']
+	if msgType == 'text':
+		fields = dict(Content=cdata(replyDict['Content']))
+	elif msgType == 'news':
+		fields = dict(ArticleCount=len(replyDict['Articles']), Articles=''.join(
+			articleTemplate.format(Title=cdata(x['Title']), Description=cdata(x.get('Description', '')),
+				PicUrl=cdata(x['PicUrl']), Url=cdata(x['Url']))
+			for name, x in replyDict['Articles']))
+	elif msgType == 'music':
+		fields = {k: cdata(v) for k, v in replyDict['Music'].items()}
+	else:
+		raise ValueError('不支持的消息类型 {}'.format(msgType))
+	return templates[msgType].format(cdata(ToUserName), cdata(FromUserName),
+			escape(str(CreateTime)), msgType, **fields).encode('utf8')
+
+
+#不解析实体、不读取DTD、不访问网络、不接受超大的文档
+parserOptions = dict(resolve_entities=False, load_dtd=False, no_network=True,
+		huge_tree=False, remove_comments=True, remove_pis=True)
+local = threading.local()
+
+
+class MessageError(ValueError):
+	pass
+
+
+def parseMessage(data):
+	'返回{标签: 文字}，只包含根节点的直接子节点。空的节点为空字符串，没有的节点不在其中'
+	parser = getattr(local, 'parser', None)
+	if parser is None:
+		parser = local.parser = etree.XMLParser(**parserOptions)
+	try:
+		root = etree.fromstring(data, parser)
+	except etree.XMLSyntaxError as e:
+		raise MessageError(str(e))
+	if root.getroottree().docinfo.doctype:
+		raise MessageError('不接受DOCTYPE')
+	return {child.tag: child.text or '' for child in root if isinstance(child.tag, str)}